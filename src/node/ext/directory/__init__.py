@@ -1,7 +1,15 @@
+from node.ext.directory.compact import CompactDirectory
+from node.ext.directory.compact import CompactFile
 from node.ext.directory.directory import Directory
 from node.ext.directory.directory import DirectoryStorage
+from node.ext.directory.directory import FactoryRegistry
 from node.ext.directory.directory import File
 from node.ext.directory.directory import file_factories
 from node.ext.directory.directory import FileStorage
+from node.ext.directory.directory import instrument
+from node.ext.directory.directory import IOStats
+from node.ext.directory.directory import PersistError
+from node.ext.directory.directory import PersistStats
 from node.ext.directory.interfaces import MODE_BINARY
+from node.ext.directory.interfaces import MODE_MMAP
 from node.ext.directory.interfaces import MODE_TEXT
@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+from node.behaviors import DefaultInit
+from node.behaviors import MappingAdopt
+from node.behaviors import MappingNode
+from node.behaviors import MappingReference
+from node.ext.directory.directory import DirectoryStorage
+from node.ext.directory.directory import FileStorage
+from node.locking import TreeLock
+from plumber import Behavior
+from plumber import default
+from plumber import plumbing
+import asyncio
+import threading
+
+
+# number of worker threads of the default executor
+DEFAULT_WORKERS = 4
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def default_executor():
+    """Return the executor shared by all async nodes which have no
+    ``async_executor`` set.
+    """
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = ThreadPoolExecutor(
+                max_workers=DEFAULT_WORKERS,
+                thread_name_prefix='node.ext.directory.aio'
+            )
+        return _default_executor
+
+
+async def _run(node, fn, *args):
+    # Run fn in the executor of the tree node belongs to. The tree gets
+    # locked while running, blocking I/O happens in worker threads only.
+    executor = getattr(node.root, 'async_executor', None)
+    if executor is None:
+        executor = default_executor()
+
+    def locked():
+        with TreeLock(node):
+            return fn(*args)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, locked)
+
+
+class _AsyncIterator(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.names is None:
+            self.names = iter(await _run(self.directory, list, self.directory))
+        try:
+            return next(self.names)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncFileStorage(Behavior):
+    """Async access to file storage.
+
+    Blocking I/O runs in ``async_executor`` of the tree root or in the
+    executor returned by ``default_executor``.
+    """
+    async_executor = default(None)
+
+    @default
+    async def read(self):
+        """Load and return file data."""
+        return await _run(self, lambda: self.data)
+
+    @default
+    async def flush(self):
+        """Persist file."""
+        await _run(self, self)
+
+
+class AsyncDirectoryStorage(Behavior):
+    """Async access to directory storage.
+
+    Blocking I/O runs in ``async_executor`` of the tree root or in the
+    executor returned by ``default_executor``.
+    """
+    async_executor = default(None)
+
+    @default
+    async def aget(self, name, default=None):
+        """Load and return child by name or ``default``."""
+        return await _run(self, self.get, name, default)
+
+    @default
+    async def flush(self, workers=None):
+        """Persist directory and all modified children."""
+        await _run(self, self, workers)
+
+    @default
+    def __aiter__(self):
+        return _AsyncIterator(self)
+
+
+@plumbing(
+    MappingAdopt,
+    DefaultInit,
+    MappingReference,
+    MappingNode,
+    FileStorage,
+    AsyncFileStorage)
+class AsyncFile(object):
+    pass
+
+
+@plumbing(
+    MappingAdopt,
+    MappingReference,
+    MappingNode,
+    DirectoryStorage,
+    AsyncDirectoryStorage)
+class AsyncDirectory(object):
+    """Object mapping a file system directory with async access.
+    """
+    default_file_factory = AsyncFile
+
+    @property
+    def child_directory_factory(self):
+        return AsyncDirectory
@@ -0,0 +1,93 @@
+from node.behaviors import DefaultInit
+from node.behaviors import MappingAdopt
+from node.behaviors import MappingNode
+from node.ext.directory.directory import DirectoryStorage
+from node.ext.directory.directory import FileStorage
+from plumber import plumbing
+
+
+# Compact nodes keep their state in slots instead of an instance ``__dict__``.
+# Slots must cover all attributes the storages set on instances, settings
+# like ``direct_sync`` or ``factories`` are class attributes and must be
+# customized by subclassing.
+_NODE_SLOTS = (
+    '__name__',
+    '__parent__',
+    '_storage',
+    '_treelock',
+    '_dirty',
+    '_fs_mode',
+    '_fs_mode_changed',
+    '_fs_path_memo',
+    'persist_stats',
+)
+
+_FILE_SLOTS = _NODE_SLOTS + (
+    '_mode',
+    '_data',
+    '_changed',
+    '_stream',
+    '_lines',
+    '_appended',
+    '_digest',
+    '_stat_sig',
+    '_mmap',
+    '_mmap_view',
+)
+
+_DIRECTORY_SLOTS = _NODE_SLOTS + (
+    '_deleted',
+    '_listing',
+    '_listing_sig',
+    '_listing_watched',
+    '_names',
+    '_watcher',
+    '_child_cache',
+    '_dir_fds',
+    '_factory_matcher',
+    '_ignores_matcher',
+    '_snapshot',
+)
+
+
+class _CompactFileSlots(object):
+    __slots__ = _FILE_SLOTS
+
+
+class _CompactDirectorySlots(object):
+    __slots__ = _DIRECTORY_SLOTS
+
+
+# ``Node`` behavior defines ``__name__`` and ``__parent__`` as class
+# attributes, which would conflict with or shadow the slots. Declaring the
+# slot descriptors on the plumbed class lets the behavior defaults yield.
+@plumbing(
+    MappingAdopt,
+    DefaultInit,
+    MappingNode,
+    FileStorage)
+class CompactFile(_CompactFileSlots):
+    """File without instance ``__dict__`` and reference handling.
+    """
+    __slots__ = ()
+    __name__ = _CompactFileSlots.__dict__['__name__']
+    __parent__ = _CompactFileSlots.__dict__['__parent__']
+
+
+@plumbing(
+    MappingAdopt,
+    MappingNode,
+    DirectoryStorage)
+class CompactDirectory(_CompactDirectorySlots):
+    """Directory without instance ``__dict__`` and reference handling.
+
+    Children are created as ``CompactFile`` and ``CompactDirectory``.
+    """
+    __slots__ = ()
+    __name__ = _CompactDirectorySlots.__dict__['__name__']
+    __parent__ = _CompactDirectorySlots.__dict__['__parent__']
+    default_file_factory = CompactFile
+
+    @property
+    def child_directory_factory(self):
+        return CompactDirectory
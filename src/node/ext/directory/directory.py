@@ -1,5 +1,8 @@
+from collections.abc import MutableSequence
+from concurrent.futures import ThreadPoolExecutor
 from node.behaviors import DefaultInit
 from node.behaviors import DictStorage
+from node.behaviors import IndexViolationError
 from node.behaviors import MappingAdopt
 from node.behaviors import MappingNode
 from node.behaviors import MappingReference
@@ -8,22 +11,736 @@ from node.ext.directory.events import FileAddedEvent
 from node.ext.directory.interfaces import IDirectory
 from node.ext.directory.interfaces import IFile
 from node.ext.directory.interfaces import MODE_BINARY
+from node.ext.directory.interfaces import MODE_MMAP
 from node.ext.directory.interfaces import MODE_TEXT
+from node.interfaces import INodeReference
 from node.locking import locktree
 from plumber import Behavior
 from plumber import default
 from plumber import finalize
+from plumber import override
 from plumber import plumbing
 from zope.component.event import objectEventNotify
 from zope.interface import implementer
+import array
+import collections
+import contextlib
+import errno
+import fnmatch
+import functools
+import hashlib
+import io
+import json
+import locale
 import logging
+import mmap
 import os
+import re
 import shutil
+import stat
+import threading
+import time
+import uuid
 
 
 logger = logging.getLogger('node.ext.directory')
 
 
+###############################################################################
+# I/O instrumentation
+###############################################################################
+
+class IOOperationStats(object):
+    """Number of calls and accumulated time of an I/O operation."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return '<IOOperationStats count={0} seconds={1:.6f}>'.format(
+            self.count,
+            self.seconds
+        )
+
+
+class IOStats(object):
+    """Statistics about file system calls and transferred data.
+
+    ``operations`` maps operation names to ``IOOperationStats``. Operations
+    are ``listdir``, ``stat``, ``open``, ``read``, ``write``, ``fsync``,
+    ``chmod``, ``mkdir``, ``remove``, ``replace`` and ``rmtree``. Data sizes
+    are counted in characters for files opened in text mode. ``nodes`` maps
+    file system paths to ``IOStats`` of the related node.
+    """
+
+    def __init__(self, track_nodes=True):
+        self.operations = dict()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.nodes = dict() if track_nodes else None
+        self._lock = threading.Lock()
+
+    def record(self, operation, path, seconds, read=0, written=0):
+        with self._lock:
+            self._record(operation, seconds, read, written)
+            if self.nodes is not None and path is not None:
+                node_stats = self.nodes.get(path)
+                if node_stats is None:
+                    node_stats = self.nodes[path] = IOStats(track_nodes=False)
+                node_stats._record(operation, seconds, read, written)
+
+    def _record(self, operation, seconds, read, written):
+        operation_stats = self.operations.get(operation)
+        if operation_stats is None:
+            operation_stats = self.operations[operation] = IOOperationStats()
+        operation_stats.count += 1
+        operation_stats.seconds += seconds
+        self.bytes_read += read
+        self.bytes_written += written
+
+    def count(self, operation):
+        """Return number of calls of operation."""
+        operation_stats = self.operations.get(operation)
+        return operation_stats.count if operation_stats is not None else 0
+
+
+def _exists(path, dir_fd=None):
+    if dir_fd is None:
+        return os.path.exists(path)
+    try:
+        os.stat(path, dir_fd=dir_fd)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _isdir(path, dir_fd=None):
+    if dir_fd is None:
+        return os.path.isdir(path)
+    try:
+        return stat.S_ISDIR(os.stat(path, dir_fd=dir_fd).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def _open(path, mode='r', dir_fd=None):
+    if dir_fd is None:
+        return open(path, mode)
+    return open(path, mode, opener=functools.partial(os.open, dir_fd=dir_fd))
+
+
+class _SysCalls(object):
+    # File system calls used by storages. Replaced by ``_InstrumentedSysCalls``
+    # while instrumentation is active, otherwise calls go directly to the
+    # underlying functions. Calls taking paths accept ``dir_fd`` for paths
+    # relative to an opened directory.
+    scandir = staticmethod(os.scandir)
+    stat = staticmethod(os.stat)
+    fstat = staticmethod(os.fstat)
+    exists = staticmethod(_exists)
+    isdir = staticmethod(_isdir)
+    open = staticmethod(_open)
+    os_open = staticmethod(os.open)
+    close = staticmethod(os.close)
+    fsync = staticmethod(os.fsync)
+    chmod = staticmethod(os.chmod)
+    mkdir = staticmethod(os.mkdir)
+    rmdir = staticmethod(os.rmdir)
+    remove = staticmethod(os.remove)
+    unlink = staticmethod(os.unlink)
+    replace = staticmethod(os.replace)
+    rmtree = staticmethod(shutil.rmtree)
+
+
+class _InstrumentedFile(object):
+    # Proxy of a file object recording reads and writes.
+
+    def __init__(self, file, path, syscalls):
+        self._file = file
+        self._path = path
+        self._syscalls = syscalls
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        line = next(self._file)
+        self._syscalls._record(
+            'read', self._path, start, read=len(line)
+        )
+        return line
+
+    def _read(self, name, *args):
+        start = time.perf_counter()
+        data = getattr(self._file, name)(*args)
+        self._syscalls._record('read', self._path, start, read=len(data))
+        return data
+
+    def read(self, *args):
+        return self._read('read', *args)
+
+    def readline(self, *args):
+        return self._read('readline', *args)
+
+    def readinto(self, buffer):
+        start = time.perf_counter()
+        size = self._file.readinto(buffer)
+        self._syscalls._record('read', self._path, start, read=size or 0)
+        return size
+
+    def write(self, data):
+        start = time.perf_counter()
+        size = self._file.write(data)
+        self._syscalls._record('write', self._path, start, written=len(data))
+        return size
+
+    def close(self):
+        if not self._file.closed:
+            self._syscalls._forget(self._file.fileno())
+        self._file.close()
+
+
+class _InstrumentedSysCalls(object):
+    # File system calls recording into all active ``IOStats``.
+
+    def __init__(self):
+        self.stats = ()
+        self.fd_paths = dict()
+
+    def _record(self, operation, path, start, read=0, written=0):
+        seconds = time.perf_counter() - start
+        for stats in self.stats:
+            stats.record(operation, path, seconds, read, written)
+
+    def _forget(self, fd):
+        self.fd_paths.pop(fd, None)
+
+    def _call(self, operation, path, func, *args, **kw):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kw)
+        finally:
+            self._record(operation, path, start)
+
+    def _fd_path(self, fd):
+        path = self.fd_paths.get(fd)
+        if path is None and os.path.isdir('/proc/self/fd'):
+            # opened before instrumentation started
+            try:
+                path = os.readlink('/proc/self/fd/{}'.format(fd))
+            except OSError:                           # pragma no cover
+                pass
+        return path
+
+    def _dir_fd_path(self, path, dir_fd):
+        # path of name relative to an opened directory
+        if dir_fd is None:
+            return path
+        return os.path.join(self._fd_path(dir_fd) or '', path)
+
+    def scandir(self, path):
+        # path is either a file system path or a file descriptor
+        node_path = self._fd_path(path) if isinstance(path, int) else path
+        return self._call('listdir', node_path, os.scandir, path)
+
+    def stat(self, path, dir_fd=None, follow_symlinks=True):
+        return self._call(
+            'stat',
+            self._dir_fd_path(path, dir_fd),
+            os.stat,
+            path,
+            dir_fd=dir_fd,
+            follow_symlinks=follow_symlinks
+        )
+
+    def exists(self, path, dir_fd=None):
+        return self._call(
+            'stat',
+            self._dir_fd_path(path, dir_fd),
+            _exists,
+            path,
+            dir_fd=dir_fd
+        )
+
+    def isdir(self, path, dir_fd=None):
+        return self._call(
+            'stat',
+            self._dir_fd_path(path, dir_fd),
+            _isdir,
+            path,
+            dir_fd=dir_fd
+        )
+
+    def fstat(self, fd):
+        return self._call('stat', self._fd_path(fd), os.fstat, fd)
+
+    def open(self, path, mode='r', dir_fd=None):
+        node_path = self._dir_fd_path(path, dir_fd)
+        file = self._call('open', node_path, _open, path, mode, dir_fd=dir_fd)
+        self.fd_paths[file.fileno()] = node_path
+        return _InstrumentedFile(file, node_path, self)
+
+    def os_open(self, path, flags, dir_fd=None):
+        node_path = self._dir_fd_path(path, dir_fd)
+        fd = self._call('open', node_path, os.open, path, flags, dir_fd=dir_fd)
+        self.fd_paths[fd] = node_path
+        return fd
+
+    def close(self, fd):
+        self._forget(fd)
+        os.close(fd)
+
+    def fsync(self, fd):
+        return self._call('fsync', self._fd_path(fd), os.fsync, fd)
+
+    def chmod(self, path, mode, dir_fd=None):
+        # path is either a file system path or a file descriptor
+        if isinstance(path, int):
+            node_path = self._fd_path(path)
+        else:
+            node_path = self._dir_fd_path(path, dir_fd)
+        return self._call(
+            'chmod',
+            node_path,
+            os.chmod,
+            path,
+            mode,
+            dir_fd=dir_fd
+        )
+
+    def mkdir(self, path, dir_fd=None):
+        return self._call(
+            'mkdir',
+            self._dir_fd_path(path, dir_fd),
+            os.mkdir,
+            path,
+            dir_fd=dir_fd
+        )
+
+    def rmdir(self, path):
+        return self._call('remove', path, os.rmdir, path)
+
+    def remove(self, path):
+        return self._call('remove', path, os.remove, path)
+
+    def unlink(self, path, dir_fd=None):
+        return self._call(
+            'remove',
+            self._dir_fd_path(path, dir_fd),
+            os.unlink,
+            path,
+            dir_fd=dir_fd
+        )
+
+    def replace(self, src, dst, src_dir_fd=None, dst_dir_fd=None):
+        return self._call(
+            'replace',
+            self._dir_fd_path(dst, dst_dir_fd),
+            os.replace,
+            src,
+            dst,
+            src_dir_fd=src_dir_fd,
+            dst_dir_fd=dst_dir_fd
+        )
+
+    def rmtree(self, path):
+        return self._call('rmtree', path, shutil.rmtree, path)
+
+
+_plain_sys = _SysCalls()
+_instrumented_sys = _InstrumentedSysCalls()
+_instrumented_sys_lock = threading.Lock()
+_sys = _plain_sys
+
+
+@contextlib.contextmanager
+def instrument(stats=None):
+    """Context manager recording file system calls of all storages.
+
+    Yield ``IOStats`` which gets filled while the context is active. Calls of
+    all threads are recorded. Without active instrumentation there is no
+    overhead beyond an attribute lookup per call.
+    """
+    global _sys
+    if stats is None:
+        stats = IOStats()
+    with _instrumented_sys_lock:
+        _instrumented_sys.stats += (stats,)
+        _sys = _instrumented_sys
+    try:
+        yield stats
+    finally:
+        with _instrumented_sys_lock:
+            active = list(_instrumented_sys.stats)
+            active.remove(stats)
+            _instrumented_sys.stats = tuple(active)
+            if not active:
+                _sys = _plain_sys
+
+
+# Windows fills ``os.DirEntry.stat`` while scanning, on POSIX systems it costs
+# an additional syscall.
+_SCANDIR_HAS_STAT = os.name == 'nt'
+
+
+# Entry of a directory listing. ``stat`` is only set if it was available
+# without an additional syscall.
+_ListingEntry = collections.namedtuple(
+    '_ListingEntry',
+    ['is_dir', 'stat', 'is_link'],
+    defaults=[False]
+)
+
+
+def _scan_directory(dir_path):
+    """Scan directory with ``os.scandir``. ``dir_path`` is either a path or
+    the file descriptor of an opened directory.
+
+    Return tuple containing a list of all entry names and a dict mapping the
+    names of existing entries to ``_ListingEntry`` instances. Names of
+    dangling symlinks are contained in the names but not in the listing.
+    """
+    names = list()
+    listing = dict()
+    try:
+        iterator = _sys.scandir(dir_path)
+    except OSError:
+        return names, listing
+    with iterator:
+        for entry in iterator:
+            name = entry.name
+            names.append(name)
+            if entry.is_symlink():
+                # symlinks need to be followed anyway, this stats the target
+                try:
+                    entry_stat = entry.stat()
+                except OSError:
+                    continue
+                is_dir = stat.S_ISDIR(entry_stat.st_mode)
+                listing[name] = _ListingEntry(is_dir, entry_stat, True)
+                continue
+            entry_stat = entry.stat() if _SCANDIR_HAS_STAT else None
+            listing[name] = _ListingEntry(entry.is_dir(), entry_stat)
+    return names, listing
+
+
+def _listing_entry(file_path, dir_fd=None):
+    """Create ``_ListingEntry`` for file path by a single ``os.stat`` call.
+
+    Return ``None`` if file path not exists.
+    """
+    try:
+        entry_stat = _sys.stat(file_path, dir_fd=dir_fd)
+    except OSError:
+        return None
+    return _ListingEntry(stat.S_ISDIR(entry_stat.st_mode), entry_stat)
+
+
+def _delete_entry(file_path, dir_fd=None):
+    """Create ``_ListingEntry`` for deleting file path by a single
+    ``os.lstat`` call.
+
+    Return ``None`` if file path not exists. Symlinks are not followed, their
+    entries have no stat result and ``is_dir`` is always ``False``.
+    """
+    try:
+        entry_stat = _sys.stat(
+            file_path,
+            dir_fd=dir_fd,
+            follow_symlinks=False
+        )
+    except OSError:
+        return None
+    if stat.S_ISLNK(entry_stat.st_mode):
+        return _ListingEntry(False, None, True)
+    return _ListingEntry(stat.S_ISDIR(entry_stat.st_mode), entry_stat)
+
+
+# Modification times within this window before loading are not trusted, as
+# further changes within the timestamp granularity of the file system cannot
+# be detected.
+_RACY_WINDOW_NS = 2 * 10 ** 9
+
+
+def _stat_signature(st):
+    # Signature of a stat result used to detect changes on the file system
+    if st is None:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _load_signature(st):
+    # Signature to remember when loading. Recently modified entries get
+    # ``False`` which never matches, thus they are reloaded on next refresh.
+    if st is not None and time.time_ns() - st.st_mtime_ns < _RACY_WINDOW_NS:
+        return False
+    return _stat_signature(st)
+
+
+# Version of the snapshot index format
+_INDEX_VERSION = 1
+
+# Kinds of snapshot index entries mapped to ``_ListingEntry`` instances
+_INDEX_KINDS = {
+    'f': _ListingEntry(False, None, False),
+    'd': _ListingEntry(True, None, False),
+    'lf': _ListingEntry(False, None, True),
+    'ld': _ListingEntry(True, None, True),
+}
+
+
+class _SnapshotIndex(object):
+    """Directory listings loaded from a snapshot index file.
+
+    ``directories`` maps directory paths to tuples containing the
+    modification time of the directory when the index was written and the
+    directory entries. A listing is only used if the modification time of
+    the directory is unchanged. Only entry types are taken from the index,
+    sizes, modification times and modes of the entries are informational.
+    """
+
+    def __init__(self, directories):
+        self.directories = directories
+
+    def listing(self, dir_path, st):
+        """Return ``(names, listing)`` of directory if the directory has not
+        been changed since the index was written, otherwise ``None``.
+        """
+        record = self.directories.get(dir_path)
+        if record is None or st is None:
+            return None
+        mtime_ns, entries = record
+        if mtime_ns is None or mtime_ns != st.st_mtime_ns:
+            return None
+        names = list()
+        listing = dict()
+        for name, kind, size, entry_mtime_ns, mode in entries:
+            names.append(name)
+            if kind is not None:
+                listing[name] = _INDEX_KINDS[kind]
+        return names, listing
+
+    @classmethod
+    def load(cls, index_path, root_path):
+        """Load snapshot index. Return ``None`` if index file not exists or
+        is invalid.
+        """
+        try:
+            with _sys.open(index_path, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning(
+                    'Cannot load snapshot index {}: {}'.format(index_path, e)
+                )
+            return None
+        if not isinstance(data, dict) or data.get('version') != _INDEX_VERSION:
+            logger.warning('Invalid snapshot index {}'.format(index_path))
+            return None
+        directories = dict()
+        for rel_path, record in data['directories'].items():
+            dir_path = os.path.join(root_path, *rel_path.split('/')) \
+                if rel_path else root_path
+            directories[dir_path] = record
+        return cls(directories)
+
+    @classmethod
+    def write(cls, index_path, root_path, previous=None):
+        """Scan directory tree at ``root_path`` and write snapshot index.
+
+        Directories unchanged since ``previous`` index was written are not
+        rescanned. Return the written index.
+        """
+        directories = dict()
+        records = dict()
+        now = time.time_ns()
+        stack = [('', root_path)]
+        while stack:
+            rel_path, dir_path = stack.pop()
+            try:
+                st = _sys.stat(dir_path)
+            except OSError:
+                continue
+            record = None
+            if previous is not None:
+                record = previous.directories.get(dir_path)
+                if record is not None and record[0] != st.st_mtime_ns:
+                    record = None
+            if record is None:
+                record = (st.st_mtime_ns, _index_entries(dir_path))
+            mtime_ns, entries = record
+            # changes within the timestamp granularity cannot be detected
+            if now - st.st_mtime_ns < _RACY_WINDOW_NS:
+                mtime_ns = None
+            directories[dir_path] = (mtime_ns, entries)
+            records[rel_path] = [mtime_ns, entries]
+            for name, kind, _, _, _ in entries:
+                if kind == 'd':
+                    stack.append((
+                        rel_path + '/' + name if rel_path else name,
+                        os.path.join(dir_path, name)
+                    ))
+
+        def write(file):
+            json.dump(
+                {'version': _INDEX_VERSION, 'directories': records},
+                file,
+                separators=(',', ':')
+            )
+
+        _write_file(index_path, 'w', write, atomic=True)
+        return cls(directories)
+
+
+def _index_entries(dir_path):
+    # Entries of directory for the snapshot index
+    entries = list()
+    try:
+        iterator = _sys.scandir(dir_path)
+    except OSError:
+        return entries
+    with iterator:
+        for entry in iterator:
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                # dangling symlink
+                entries.append([entry.name, None, 0, 0, 0])
+                continue
+            kind = 'd' if stat.S_ISDIR(entry_stat.st_mode) else 'f'
+            if entry.is_symlink():
+                kind = 'l' + kind
+            entries.append([
+                entry.name,
+                kind,
+                entry_stat.st_size,
+                entry_stat.st_mtime_ns,
+                stat.S_IMODE(entry_stat.st_mode)
+            ])
+    return entries
+
+
+def _release(node):
+    # Release loaded data of node and all its loaded children
+    if IDirectory.providedBy(node):
+        cache = getattr(node, '_dir_fds', None)
+        if cache is not None:
+            cache.discard(node)
+        for child in node.storage.values():
+            _release(child)
+    elif hasattr(node, '_release_data'):
+        node._release_data()
+
+
+def _close_dir_fds(node):
+    # Close cached file descriptors of directory node and its loaded
+    # subdirectories
+    cache = getattr(node, '_dir_fds', None)
+    if cache is None or not IDirectory.providedBy(node):
+        return
+    cache.discard(node)
+    for child in node.storage.values():
+        _close_dir_fds(child)
+
+
+class _ChildCache(object):
+    """Tree wide LRU bookkeeping of children created from the file system.
+
+    Children are tracked when created by ``_create_child_by_factory``. If the
+    number of tracked children exceeds ``max_entries`` or the size of loaded
+    file data exceeds ``max_bytes``, least recently used children which are
+    not modified get removed from their parent storage. They get reloaded
+    from the file system on next access.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.sizes = dict()
+        self.size = 0
+
+    def __contains__(self, child):
+        return id(child) in self.entries
+
+    def add(self, child):
+        self.entries[id(child)] = child
+        self.touch(child)
+        self.enforce(keep=child)
+
+    def touch(self, child):
+        # mark child and all tracked parents as recently used
+        entries = self.entries
+        node = child
+        while id(node) in entries:
+            entries.move_to_end(id(node))
+            node = node.__parent__
+
+    def loaded(self, child, size):
+        key = id(child)
+        if key not in self.entries:
+            return
+        self.size += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+        self.enforce(keep=child)
+
+    def discard(self, child):
+        key = id(child)
+        if self.entries.pop(key, None) is None:
+            return
+        self.size -= self.sizes.pop(key, 0)
+        if IDirectory.providedBy(child):
+            for grandchild in child.storage.values():
+                self.discard(grandchild)
+
+    def exceeded(self):
+        if self.max_entries is not None \
+                and len(self.entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.size > self.max_bytes
+
+    def evictable(self, child):
+        # dirty children are never evicted
+        return not _is_dirty(child)
+
+    def evict(self, child):
+        parent = child.__parent__
+        name = child.__name__
+        if parent is None or parent.storage.get(name) is not child:
+            self.discard(child)
+            return
+        parent._drop_child(name)
+
+    def enforce(self, keep=None):
+        if not self.exceeded():
+            return
+        # never evict the given child or one of its parents
+        keep_keys = set()
+        node = keep
+        while node is not None:
+            keep_keys.add(id(node))
+            node = node.__parent__
+        entries = self.entries
+        candidates = len(entries)
+        while candidates and self.exceeded():
+            candidates -= 1
+            key, child = entries.popitem(last=False)
+            entries[key] = child
+            if key not in keep_keys and self.evictable(child):
+                self.evict(child)
+
+
 def _fs_path(ob):
     # Use fs_path if provided by ob, otherwise fallback to path
     if hasattr(ob, 'fs_path'):
@@ -31,11 +748,1108 @@ def _fs_path(ob):
     return ob.path
 
 
-def _fs_mode(ob):
-    fs_path = os.path.join(*_fs_path(ob))
-    if not os.path.exists(fs_path):
-        return None
-    return os.stat(fs_path).st_mode & 0o777
+# Incremented if a directory with memoized path gets added to a directory,
+# i.e. is moved or renamed. Memoized paths of all nodes are invalid then.
+_path_epoch = 0
+
+
+class _PathMemo(object):
+    """Memoized path of a node.
+
+    Valid as long as no directory has been moved since, and the name and
+    parent of the node and the name and parent of its root are unchanged.
+    """
+    __slots__ = (
+        'epoch',
+        'name',
+        'parent',
+        'root',
+        'root_name',
+        'root_parent',
+        'path',
+        'joined'
+    )
+
+    def __init__(self, ob, path, root):
+        self.epoch = _path_epoch
+        self.name = ob.__name__
+        self.parent = ob.__parent__
+        self.root = root
+        self.root_name = root.__name__
+        self.root_parent = root.__parent__
+        self.path = path
+        self.joined = None
+
+    def valid(self, ob):
+        if self.epoch != _path_epoch \
+                or self.parent is not ob.__parent__ \
+                or self.name != ob.__name__:
+            return False
+        root = self.root
+        return root is ob or (
+            root.__name__ == self.root_name
+            and root.__parent__ is self.root_parent
+        )
+
+
+def _path_memo(ob):
+    # Return memoized path of storage node. Built from the memoized path of
+    # the parent if it is a storage node as well.
+    memo = getattr(ob, '_fs_path_memo', None)
+    if memo is not None and memo.valid(ob):
+        return memo
+    parent = ob.__parent__
+    if getattr(type(parent), 'fs_path', None) is _memoized_fs_path:
+        parent_memo = _path_memo(parent)
+        path = parent_memo.path + [ob.__name__]
+        memo = _PathMemo(ob, path, parent_memo.root)
+    else:
+        memo = _PathMemo(ob, ob.path, ob)
+    ob._fs_path_memo = memo
+    return memo
+
+
+def _fs_join(ob):
+    # Joined file system path of ob. Memoized unless fs_path is customized.
+    if getattr(type(ob), 'fs_path', None) is _memoized_fs_path:
+        memo = _path_memo(ob)
+        if memo.joined is None:
+            memo.joined = os.path.join(*memo.path)
+        return memo.joined
+    return os.path.join(*_fs_path(ob))
+
+
+def _fs_mode(ob):
+    try:
+        with _opened_parent(ob) as dir_fd:
+            return _sys.stat(
+                _fs_target(ob, dir_fd),
+                dir_fd=dir_fd
+            ).st_mode & 0o777
+    except OSError:
+        return None
+
+
+def _write_file(file_path, mode, write, sync=False, atomic=False,
+                dir_fd=None):
+    """Write file by calling ``write`` with the opened file object.
+
+    If ``atomic`` is set, a temporary file in the same directory is written,
+    synced and moved to ``file_path``. The mode of an existing file is kept.
+    Syncing the containing directory is up to the caller. If ``dir_fd`` is
+    given, ``file_path`` is relative to this opened directory.
+    """
+    if not atomic:
+        with _sys.open(file_path, mode, dir_fd=dir_fd) as file:
+            write(file)
+            if sync:
+                file.flush()
+                _sys.fsync(file.fileno())
+        return
+    dir_path, name = os.path.split(file_path)
+    tmp_path = os.path.join(
+        dir_path,
+        '.{}.{}.tmp'.format(name, uuid.uuid4().hex)
+    )
+    try:
+        existing_mode = stat.S_IMODE(
+            _sys.stat(file_path, dir_fd=dir_fd).st_mode
+        )
+    except OSError:
+        existing_mode = None
+    try:
+        with _sys.open(tmp_path, mode.replace('w', 'x'), dir_fd=dir_fd) \
+                as file:
+            if existing_mode is not None:
+                _sys.chmod(file.fileno(), existing_mode)
+            write(file)
+            file.flush()
+            _sys.fsync(file.fileno())
+        _sys.replace(
+            tmp_path,
+            file_path,
+            src_dir_fd=dir_fd,
+            dst_dir_fd=dir_fd
+        )
+    except BaseException:
+        try:
+            _sys.unlink(tmp_path, dir_fd=dir_fd)
+        except OSError:
+            pass
+        raise
+
+
+def _content_digest(data):
+    # Digest of file contents, text is hashed UTF-8 encoded
+    if isinstance(data, str):
+        data = data.encode('utf-8', 'surrogatepass')
+    return hashlib.blake2b(data).digest()
+
+
+def _file_digest(file_path, binary, dir_fd=None):
+    # Digest of file contents on disk as returned by ``_content_digest``.
+    # Return ``None`` if the file cannot be read.
+    digest = hashlib.blake2b()
+    try:
+        with _sys.open(file_path, binary and 'rb' or 'r', dir_fd=dir_fd) \
+                as file:
+            while True:
+                chunk = file.read(io.DEFAULT_BUFFER_SIZE * 8)
+                if not chunk:
+                    break
+                if not binary:
+                    chunk = chunk.encode('utf-8', 'surrogatepass')
+                digest.update(chunk)
+    except (OSError, ValueError):
+        return None
+    return digest.digest()
+
+
+_DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+
+# whether entries can be removed relative to an opened directory
+_unlink_dir_fd = os.unlink in os.supports_dir_fd \
+    and os.stat in os.supports_dir_fd
+
+
+@contextlib.contextmanager
+def _open_directory(dir_path):
+    # Open directory for calls relative to it. Yield ``None`` if not
+    # supported by the platform.
+    if not _unlink_dir_fd:
+        yield None                                    # pragma no cover
+        return
+    fd = _sys.os_open(dir_path, _DIR_FLAGS)
+    try:
+        yield fd
+    finally:
+        _sys.close(fd)
+
+
+# whether all file system calls of storages can be made relative to opened
+# directories. ``os.replace`` supports ``dir_fd`` if ``os.rename`` does.
+_dir_fd_supported = _unlink_dir_fd \
+    and all(func in os.supports_dir_fd for func in (
+        os.open, os.mkdir, os.chmod, os.rename
+    )) \
+    and os.scandir in os.supports_fd
+
+
+class _DirFDCache(object):
+    """Bounded cache of opened directory file descriptors of a tree.
+
+    Directories get opened relative to the descriptor of their parent
+    directory. Least recently used descriptors get closed if more than
+    ``max_entries`` are open. Descriptors are never closed while in use.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # id of directory node -> (node, fd)
+        self.entries = collections.OrderedDict()
+        # usage counts and descriptors of discarded nodes still in use
+        self.pins = dict()
+        self.orphans = dict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @contextlib.contextmanager
+    def opened(self, node):
+        """Yield file descriptor of directory node, which gets opened if not
+        cached yet.
+        """
+        key = id(node)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                fd = entry[1]
+            else:
+                fd = self._open(node)
+                self.entries[key] = (node, fd)
+            self.pins[key] = self.pins.get(key, 0) + 1
+            self._evict()
+        try:
+            yield fd
+        finally:
+            with self.lock:
+                count = self.pins.pop(key) - 1
+                if count:
+                    self.pins[key] = count
+                else:
+                    for orphan in self.orphans.pop(key, ()):
+                        _sys.close(orphan)
+                    self._evict()
+
+    def _open(self, node):
+        parent = node.__parent__
+        if getattr(parent, '_dir_fds', None) is self:
+            with self.opened(parent) as parent_fd:
+                return _sys.os_open(
+                    node.__name__,
+                    _DIR_FLAGS,
+                    dir_fd=parent_fd
+                )
+        return _sys.os_open(_fs_join(node), _DIR_FLAGS)
+
+    def _evict(self):
+        excess = len(self.entries) - self.max_entries
+        if excess <= 0:
+            return
+        victims = list()
+        for key in self.entries:
+            if key not in self.pins:
+                victims.append(key)
+                if len(victims) == excess:
+                    break
+        for key in victims:
+            _sys.close(self.entries.pop(key)[1])
+
+    def discard(self, node):
+        """Close file descriptor of directory node if cached."""
+        key = id(node)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            if key in self.pins:
+                self.orphans.setdefault(key, list()).append(entry[1])
+            else:
+                _sys.close(entry[1])
+
+    def close(self):
+        """Close all unused file descriptors."""
+        with self.lock:
+            for key in list(self.entries):
+                if key not in self.pins:
+                    _sys.close(self.entries.pop(key)[1])
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:                             # pragma no cover
+            pass
+
+
+@contextlib.contextmanager
+def _opened_parent(ob):
+    # Yield file descriptor of the opened parent directory of ob if file
+    # system calls are made relative to it, otherwise ``None``
+    parent = ob.__parent__
+    cache = getattr(parent, '_dir_fds', None)
+    if cache is None:
+        yield None
+        return
+    with cache.opened(parent) as dir_fd:
+        yield dir_fd
+
+
+@contextlib.contextmanager
+def _opened_directory(node, dir_path):
+    # Yield file descriptor of directory node from cache if file system calls
+    # are made relative to opened directories, otherwise open ``dir_path``
+    cache = getattr(node, '_dir_fds', None)
+    if cache is None:
+        with _open_directory(dir_path) as dir_fd:
+            yield dir_fd
+        return
+    with cache.opened(node) as dir_fd:
+        yield dir_fd
+
+
+def _fs_target(ob, dir_fd):
+    # Name of ob relative to the opened parent directory if given, otherwise
+    # file system path of ob
+    if dir_fd is not None:
+        return ob.__name__
+    return _fs_join(ob)
+
+
+def _rmtree(dir_path, executor=None):
+    """Remove directory tree.
+
+    If ``executor`` is given, subdirectories get removed in parallel by it.
+    """
+    if executor is None:
+        _sys.rmtree(dir_path)
+        return
+    futures = list()
+    with _sys.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                futures.append(executor.submit(_sys.rmtree, entry.path))
+            else:
+                _sys.remove(entry.path)
+    # wait for all subdirectories before raising
+    error = None
+    for future in futures:
+        error = error or future.exception()
+    if error is not None:
+        raise error
+    _sys.rmdir(dir_path)
+
+
+def _sync_directory(dir_path):
+    # Directories cannot be opened for syncing on Windows
+    if os.name == 'nt':
+        return                                        # pragma no cover
+    fd = _sys.os_open(dir_path, _DIR_FLAGS)
+    try:
+        _sys.fsync(fd)
+    finally:
+        _sys.close(fd)
+
+
+def _refresh_fs_mode(ob, st):
+    # Update not explicitly set file system mode from stat result
+    if hasattr(ob, '_fs_mode_changed'):
+        return
+    if st is not None:
+        ob._fs_mode = st.st_mode & 0o777
+    elif hasattr(ob, '_fs_mode'):
+        del ob._fs_mode
+
+
+def _set_setting(ob, name, value):
+    # Set setting on node instance. Nodes without instance ``__dict__`` only
+    # support settings defined on the class.
+    try:
+        setattr(ob, name, value)
+    except AttributeError:
+        raise TypeError((
+            '``{0}`` cannot be set on ``{1}`` instances, define it on a '
+            'subclass instead'
+        ).format(name, type(ob).__name__))
+
+
+def _is_dirty(ob):
+    # Nodes not created from the file system are dirty until persisted
+    return getattr(ob, '_dirty', True)
+
+
+def _set_dirty(ob):
+    # Mark node and all its parents dirty. If a node is dirty, all its parents
+    # are dirty as well, thus we can stop at the first dirty node.
+    evicted = None
+    while ob is not None and not _is_dirty(ob):
+        ob._dirty = True
+        parent = ob.__parent__
+        if IDirectory.providedBy(parent) \
+                and parent.storage.get(ob.__name__) is not ob:
+            if evicted is None:
+                evicted = list()
+            evicted.append((parent, ob))
+        ob = parent
+    # re-adopt top down to keep the reference index consistent
+    if evicted is not None:
+        for parent, ob in reversed(evicted):
+            _readopt(parent, ob)
+
+
+def _readopt(parent, ob):
+    # Put node which has been evicted or dropped from memory back to parent
+    # storage if it gets modified, otherwise the changes would get lost.
+    # Deleted names and other modified nodes at the same name are kept.
+    name = ob.__name__
+    if name in parent._deleted:
+        return
+    existing = parent.storage.get(name)
+    if existing is not None:
+        if _is_dirty(existing):
+            return
+        parent._drop_child(name)
+    if INodeReference.providedBy(parent):
+        ob._init_reference_index()
+        parent._update_reference_index(ob)
+    parent.storage[name] = ob
+    cache = parent._child_cache
+    if cache is not None:
+        cache.add(ob)
+
+
+class PersistStats(object):
+    """Statistics about a persist run. Available as ``persist_stats`` on the
+    called node.
+    """
+
+    def __init__(self):
+        # number of written files and created or changed directories
+        self.written = 0
+        # number of deleted files and directories
+        self.deleted = 0
+        # number of skipped writes of files with identical contents
+        self.suppressed = 0
+
+
+class PersistError(RuntimeError):
+    """Raised if persisting nodes in parallel fails.
+
+    ``errors`` contains ``(path, exception)`` tuples for all failed nodes.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(PersistError, self).__init__(
+            'Persisting failed for {} node(s): {}'.format(
+                len(errors),
+                '; '.join(
+                    '{}: {}'.format(path, error) for path, error in errors
+                )
+            )
+        )
+
+
+class _PersistContext(object):
+    """State of a persist run passed to ``_persist`` of the nodes.
+
+    If ``executor`` is given, file nodes get persisted by it.
+    """
+
+    def __init__(self, executor=None):
+        self.stats = PersistStats()
+        self.executor = executor
+        self.futures = list()
+        self.failures = list()
+        self.sync_dirs = dict()
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            setattr(self.stats, name, getattr(self.stats, name) + value)
+
+    def sync_directory(self, dir_path, node=None):
+        # Directories get synced once at the end of the persist run. The
+        # opened descriptor of directory node gets synced if available.
+        with self.lock:
+            self.sync_dirs[dir_path] = node
+
+    def sync_directories(self):
+        while self.sync_dirs:
+            dir_path, node = self.sync_dirs.popitem()
+            cache = getattr(node, '_dir_fds', None)
+            if cache is None:
+                _sync_directory(dir_path)
+                continue
+            with cache.opened(node) as dir_fd:
+                _sys.fsync(dir_fd)
+
+    def submit(self, node):
+        future = self.executor.submit(node._persist, self)
+        self.futures.append((node, future))
+
+    def fail(self, node, path, error):
+        # Record error of path persisted by node, reported by ``wait``
+        with self.lock:
+            self.failures.append((node, path, error))
+
+    def remember(self, node):
+        # Remember persist state of node before persisting it. Only needed
+        # for rolling back transactions.
+        pass
+
+    def opened_parent(self, node):
+        # Context manager yielding file descriptor of the opened parent
+        # directory of node if calls are made relative to it. Paths passed
+        # to the file system operations below are relative to ``dir_fd``
+        # if given.
+        return _opened_parent(node)
+
+    def exists(self, path, dir_fd=None):
+        return _sys.exists(path, dir_fd=dir_fd)
+
+    def mkdir(self, dir_path, dir_fd=None):
+        # Create directory, return whether it has been created
+        try:
+            _sys.mkdir(dir_path, dir_fd=dir_fd)
+        except OSError as e:
+            # Ignore ``already exists``.
+            if e.errno != errno.EEXIST:
+                raise e                                   # pragma no cover
+            if not _sys.isdir(dir_path, dir_fd=dir_fd):
+                raise KeyError(
+                    'Attempt to create a directory with name which '
+                    'already exists as file')
+            return False
+        return True
+
+    def chmod(self, path, mode, dir_fd=None):
+        _sys.chmod(path, mode, dir_fd=dir_fd)
+
+    def delete_entries(self, node, dir_path, entries):
+        """Delete entries of directory ``dir_path`` persisted by ``node``.
+
+        ``entries`` is a list of ``(name, listing_entry)`` tuples. Listing
+        entry is ``None`` if unknown. Files and symlinks are unlinked
+        relative to the opened directory, directories are removed by
+        ``_rmtree`` using the executor. Errors are recorded per entry.
+
+        Return number of deleted entries and list of failed names.
+        """
+        deleted = 0
+        failed = list()
+        directories = list()
+        pending = list()
+        for name, entry in entries:
+            if entry is not None and entry.is_dir and not entry.is_link:
+                directories.append(name)
+            else:
+                pending.append((name, entry))
+        if pending:
+            try:
+                deleted = self._unlink_entries(
+                    node,
+                    dir_path,
+                    pending,
+                    directories,
+                    failed
+                )
+            except FileNotFoundError:
+                # directory is gone
+                return deleted, failed
+        for name in directories:
+            path = os.path.join(dir_path, name)
+            try:
+                _rmtree(path, executor=self.executor)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                self.fail(node, path, e)
+                failed.append(name)
+                continue
+            deleted += 1
+        return deleted, failed
+
+    def _unlink_entries(self, node, dir_path, entries, directories, failed):
+        # Unlink entries relative to opened directory. Names of directories
+        # get added to ``directories``, names which failed to ``failed``.
+        # Return number of unlinked entries.
+        unlinked = 0
+        with _opened_directory(node, dir_path) as dir_fd:
+            for name, entry in entries:
+                target = name if dir_fd is not None \
+                    else os.path.join(dir_path, name)
+                try:
+                    if entry is None:
+                        st = _sys.stat(
+                            target,
+                            dir_fd=dir_fd,
+                            follow_symlinks=False
+                        )
+                        if stat.S_ISDIR(st.st_mode):
+                            directories.append(name)
+                            continue
+                    _sys.unlink(target, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    continue
+                except IsADirectoryError:
+                    # listing is outdated
+                    directories.append(name)
+                    continue
+                except OSError as e:
+                    self.fail(node, os.path.join(dir_path, name), e)
+                    failed.append(name)
+                    continue
+                unlinked += 1
+        return unlinked
+
+    def write_file(self, file_path, mode, write, sync=False, atomic=False,
+                   dir_fd=None):
+        _write_file(
+            file_path,
+            mode,
+            write,
+            sync=sync,
+            atomic=atomic,
+            dir_fd=dir_fd
+        )
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def wait(self):
+        for node, future in self.futures:
+            error = future.exception()
+            if error is not None:
+                self.failures.append(
+                    (node, _fs_join(node), error)
+                )
+        self.futures = list()
+        errors = list()
+        for node, path, error in self.failures:
+            # the failed node is still dirty, parents might be clean already
+            while node is not None:
+                node._dirty = True
+                node = node.__parent__
+            errors.append((path, error))
+        self.failures = list()
+        return errors
+
+
+def _persist_child(child, context):
+    # Persist child node. Nodes not providing ``_persist`` get called.
+    if hasattr(child, '_persist'):
+        child._persist(context)
+    else:
+        child()
+
+
+# attributes describing the persist state of nodes
+_PERSIST_STATE = (
+    '_changed',
+    '_appended',
+    '_stream',
+    '_fs_mode_changed',
+    '_dirty'
+)
+
+
+class _ConsumedStream(object):
+    """Placeholder for a ``write_from`` source which has been consumed by a
+    rolled back persist run without a copy of the written data.
+    """
+
+    def _consumed(self, *args):
+        raise RuntimeError(
+            'Source given to ``write_from`` has been consumed by a failed '
+            'persist run'
+        )
+
+    read = __iter__ = _consumed
+
+
+class _TransactionContext(_PersistContext):
+    """Persist context staging all changes of a persist run.
+
+    Files get written to a staging directory next to the persisted
+    directory. Deletes, created directories, moving staged files in place and
+    file mode changes are recorded and applied in order by ``commit``. Applied
+    changes are undone in reverse order if applying fails.
+    """
+
+    def __init__(self, dir_path, executor=None):
+        super(_TransactionContext, self).__init__(executor=executor)
+        parent_path, name = os.path.split(os.path.abspath(dir_path))
+        self.staging = os.path.join(
+            parent_path,
+            '.{}.{}.txn'.format(name, uuid.uuid4().hex)
+        )
+        _sys.mkdir(self.staging)
+        self.staged = 0
+        self.deletes = list()
+        self.deleted = set()
+        self.mkdirs = list()
+        self.created = set()
+        self.writes = list()
+        self.written = dict()
+        self.chmods = list()
+        self.states = list()
+        self.undo = list()
+
+    def _staging_path(self):
+        with self.lock:
+            self.staged += 1
+            return os.path.join(self.staging, str(self.staged))
+
+    def _pending_delete(self, path):
+        # whether path or one of its parents gets deleted
+        while True:
+            if path in self.deleted:
+                return True
+            parent_path = os.path.dirname(path)
+            if parent_path == path:
+                return False
+            path = parent_path
+
+    def remember(self, node):
+        state = dict()
+        for name in _PERSIST_STATE:
+            if hasattr(node, name):
+                state[name] = getattr(node, name)
+        if IDirectory.providedBy(node):
+            state['_deleted'] = list(node._deleted)
+        with self.lock:
+            self.states.append((node, state))
+
+    def opened_parent(self, node):
+        # Changes are applied by path, ``dir_fd`` passed to the file system
+        # operations is always ``None``
+        return contextlib.nullcontext()
+
+    def exists(self, path, dir_fd=None):
+        if path in self.created:
+            return True
+        if self._pending_delete(path):
+            return False
+        return _sys.exists(path)
+
+    def mkdir(self, dir_path, dir_fd=None):
+        if self.exists(dir_path):
+            if dir_path not in self.created and not _sys.isdir(dir_path):
+                raise KeyError(
+                    'Attempt to create a directory with name which '
+                    'already exists as file')
+            return False
+        self.mkdirs.append(dir_path)
+        self.created.add(dir_path)
+        return True
+
+    def chmod(self, path, mode, dir_fd=None):
+        with self.lock:
+            self.chmods.append((path, mode))
+
+    def delete(self, path):
+        if not self.exists(path):
+            return False
+        self.deletes.append(path)
+        self.deleted.add(path)
+        return True
+
+    def delete_entries(self, node, dir_path, entries):
+        # deletes are staged, errors are raised by ``commit``
+        deleted = 0
+        for name, entry in entries:
+            if self.delete(os.path.join(dir_path, name)):
+                deleted += 1
+        return deleted, []
+
+    def write_file(self, file_path, mode, write, sync=False, atomic=False,
+                   dir_fd=None):
+        staged_path = self._staging_path()
+        existing_mode = None
+        if self.exists(file_path) and file_path not in self.created:
+            existing_mode = stat.S_IMODE(_sys.stat(file_path).st_mode)
+            # appending needs the existing contents
+            if 'a' in mode:
+                shutil.copyfile(file_path, staged_path)
+        _write_file(staged_path, mode, write, sync=sync or atomic)
+        if existing_mode is not None:
+            _sys.chmod(staged_path, existing_mode)
+        with self.lock:
+            self.writes.append((staged_path, file_path))
+            self.written[file_path] = staged_path
+
+    def commit(self):
+        undo = self.undo
+        for path in self.deletes:
+            trash_path = self._staging_path()
+            _sys.replace(path, trash_path)
+            undo.append((_sys.replace, trash_path, path))
+        for dir_path in self.mkdirs:
+            _sys.mkdir(dir_path)
+            undo.append((_sys.rmdir, dir_path))
+        for staged_path, file_path in self.writes:
+            if _sys.exists(file_path):
+                backup_path = self._staging_path()
+                _sys.replace(file_path, backup_path)
+                undo.append((_sys.replace, backup_path, file_path))
+            _sys.replace(staged_path, file_path)
+            undo.append((_sys.replace, file_path, staged_path))
+        for path, mode in self.chmods:
+            existing_mode = stat.S_IMODE(_sys.stat(path).st_mode)
+            _sys.chmod(path, mode)
+            undo.append((_sys.chmod, path, existing_mode))
+        del undo[:]
+
+    def rollback(self):
+        # undo applied changes
+        while self.undo:
+            step = self.undo.pop()
+            try:
+                step[0](*step[1:])
+            except OSError as e:
+                logger.error('Rolling back {} failed: {}'.format(step, e))
+        # restore persist state of nodes
+        for node, state in reversed(self.states):
+            consumed = '_stream' in state and not hasattr(node, '_stream')
+            for name in _PERSIST_STATE:
+                if name in state:
+                    setattr(node, name, state[name])
+                elif hasattr(node, name):
+                    delattr(node, name)
+            if '_deleted' in state:
+                node._deleted = _DeletedNames(state['_deleted'])
+            if consumed:
+                self._restore_stream(node)
+        self.sync_dirs.clear()
+
+    def _restore_stream(self, node):
+        # A consumed ``write_from`` source cannot be read again. Its data is
+        # loaded from the staged file, which has been moved back to staging
+        # if already applied.
+        staged_path = self.written.get(_fs_join(node))
+        if staged_path is None:
+            # consumed partly or completely without staged copy
+            node._stream = _ConsumedStream()
+            return
+        binary = node.mode in (MODE_BINARY, MODE_MMAP)
+        with _sys.open(staged_path, binary and 'rb' or 'r') as f:
+            node._data = f.read()
+        del node._stream
+
+    def close(self):
+        # removes staged files and deleted entries
+        _sys.rmtree(self.staging)
+
+
+_glob_magic = re.compile('[*?[]')
+
+
+class _IgnoreMatcher(object):
+    """Matcher for ignored child names.
+
+    Exact names are looked up in a set. ``fnmatch`` style patterns like
+    ``*.pyc`` are compiled into a single regular expression. Compiled regular
+    expressions are searched in the child name.
+    """
+
+    def __init__(self, ignores):
+        self.names = set()
+        self.expressions = list()
+        patterns = list()
+        for ignore in ignores:
+            if isinstance(ignore, re.Pattern):
+                self.expressions.append(ignore)
+            elif _glob_magic.search(ignore) is not None:
+                patterns.append(fnmatch.translate(ignore))
+            else:
+                self.names.add(ignore)
+        self.pattern = re.compile('|'.join(patterns)).match \
+            if patterns else None
+
+    def __contains__(self, name):
+        if name in self.names:
+            return True
+        if self.pattern is not None and self.pattern(name):
+            return True
+        for expression in self.expressions:
+            if expression.search(name):
+                return True
+        return False
+
+
+def _ignores_signature(ignores):
+    # Signature used to detect changes of ignores
+    return (id(ignores), tuple(ignores))
+
+
+def _ignores_of(factory):
+    # Ignore matcher for directories created by factory. Ignores are only
+    # considered if defined as class attribute.
+    ignores = getattr(factory, 'ignores', ())
+    if not isinstance(ignores, (list, tuple, set, frozenset)):
+        ignores = ()
+    return _IgnoreMatcher(ignores)
+
+
+class _DeletedNames(list):
+    """List of deleted child names with set backed membership test."""
+
+    def __init__(self, names=()):
+        super(_DeletedNames, self).__init__()
+        self._counts = dict()
+        self.extend(names)
+
+    def __contains__(self, name):
+        return name in self._counts
+
+    def _add(self, name):
+        self._counts[name] = self._counts.get(name, 0) + 1
+
+    def _discard(self, name):
+        count = self._counts[name] - 1
+        if count:
+            self._counts[name] = count
+        else:
+            del self._counts[name]
+
+    def _recount(self):
+        counts = self._counts = dict()
+        for name in self:
+            counts[name] = counts.get(name, 0) + 1
+
+    def __setitem__(self, index, name):
+        if isinstance(index, slice):
+            super(_DeletedNames, self).__setitem__(index, name)
+            self._recount()
+            return
+        existing = self[index]
+        super(_DeletedNames, self).__setitem__(index, name)
+        self._discard(existing)
+        self._add(name)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            super(_DeletedNames, self).__delitem__(index)
+            self._recount()
+            return
+        existing = self[index]
+        super(_DeletedNames, self).__delitem__(index)
+        self._discard(existing)
+
+    def __iadd__(self, names):
+        self.extend(names)
+        return self
+
+    def __imul__(self, count):
+        super(_DeletedNames, self).__imul__(count)
+        self._recount()
+        return self
+
+    def append(self, name):
+        super(_DeletedNames, self).append(name)
+        self._add(name)
+
+    def extend(self, names):
+        for name in names:
+            self.append(name)
+
+    def insert(self, index, name):
+        super(_DeletedNames, self).insert(index, name)
+        self._add(name)
+
+    def pop(self, index=-1):
+        name = super(_DeletedNames, self).pop(index)
+        self._discard(name)
+        return name
+
+    def remove(self, name):
+        super(_DeletedNames, self).remove(name)
+        self._discard(name)
+
+    def clear(self):
+        super(_DeletedNames, self).__delitem__(slice(None))
+        self._counts.clear()
+
+
+def _walk_level(node, dir_path, ignores, index=None):
+    """Return directory and file names of a directory for ``walk``.
+
+    If ``node`` is given, the loaded directory node is considered. Otherwise
+    the directory listing is taken from snapshot ``index`` if valid or the
+    directory gets scanned without creating any nodes.
+
+    Return tuple of directory names, file names and names of directories
+    which are symlinks.
+    """
+    dirnames = list()
+    filenames = list()
+    links = set()
+    if node is not None:
+        names = list(node)
+        listing = node._listing
+        storage = node.storage
+    else:
+        indexed = None
+        if index is not None:
+            try:
+                indexed = index.listing(dir_path, _sys.stat(dir_path))
+            except OSError:
+                pass
+        if indexed is not None:
+            names, listing = indexed
+        else:
+            names, listing = _scan_directory(dir_path)
+        storage = {}
+    for name in names:
+        if node is None and name in ignores:
+            continue
+        child = storage.get(name)
+        if child is not None:
+            is_dir = IDirectory.providedBy(child)
+        else:
+            entry = listing.get(name)
+            if entry is None:
+                # dangling symlink
+                continue
+            is_dir = entry.is_dir
+            if is_dir and entry.is_link:
+                links.add(name)
+        if is_dir:
+            dirnames.append(name)
+        else:
+            filenames.append(name)
+    return dirnames, filenames, links
+
+
+def _walk(level, ignores, max_depth=None, follow_symlinks=False, index=None):
+    # Walk directory tree top-down starting at level, which is a tuple
+    # containing the relative path, the loaded directory node or None and the
+    # file system path. Yield levels with directory and file names.
+    stack = [level]
+    while stack:
+        level = stack.pop()
+        path, node, dir_path = level
+        dirnames, filenames, links = _walk_level(
+            node,
+            dir_path,
+            ignores,
+            index=index
+        )
+        yield level, dirnames, filenames
+        if max_depth is not None and len(path) >= max_depth:
+            continue
+        for name in reversed(dirnames):
+            child = None
+            if node is not None:
+                child = node.storage.get(name)
+            if child is None and name in links and not follow_symlinks:
+                continue
+            stack.append((path + (name,), child, os.path.join(dir_path, name)))
+
+
+def _glob(level, parts, ignores, names=None, index=None):
+    # Yield relative paths matching pattern parts below level. ``names`` are
+    # the directory and file names of level if already known.
+    path, node, dir_path = level
+    part, rest = parts[0], parts[1:]
+    if part == '**':
+        for level, dirnames, filenames in _walk(level, ignores, index=index):
+            if rest:
+                names = (dirnames, filenames)
+                for match in _glob(level, rest, ignores, names, index):
+                    yield match
+            elif level[0]:
+                yield level[0]
+        return
+    if names is None:
+        names = _walk_level(node, dir_path, ignores, index=index)[:2]
+    dirnames, filenames = names
+    candidates = dirnames if rest else dirnames + filenames
+    if _glob_magic.search(part) is not None:
+        matches = fnmatch.filter(candidates, part)
+    else:
+        matches = [part] if part in candidates else []
+    for name in matches:
+        if not rest:
+            yield path + (name,)
+            continue
+        child = None
+        if node is not None:
+            child = node.storage.get(name)
+        child_level = (path + (name,), child, os.path.join(dir_path, name))
+        for match in _glob(child_level, rest, ignores, index=index):
+            yield match
+
+
+class _FSPathMixin(Behavior):
+
+    @default
+    @property
+    def fs_path(self):
+        # Memoized, see ``_path_memo``. A copy is returned to keep the
+        # memoized path intact if callers modify it.
+        return list(_path_memo(self).path)
+
+
+_memoized_fs_path = _FSPathMixin.__dict__['fs_path'].payload
 
 
 class _FSModeMixin(Behavior):
@@ -53,11 +1867,170 @@ class _FSModeMixin(Behavior):
     @fs_mode.setter
     def fs_mode(self, mode):
         self._fs_mode = mode
+        self._fs_mode_changed = True
+        _set_dirty(self)
+
+
+class _LinesView(MutableSequence):
+    """Lines of a text file indexed by line start offsets.
+
+    Lines are sliced from the file data on access instead of splitting the
+    whole data. Edits are recorded per line and joined to file data when
+    data is read or the file gets persisted.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._reset()
+
+    def _reset(self):
+        self._base = None
+        self._offsets = None
+        # line sources after first edit, either index of base line or text
+        self._items = None
+
+    @property
+    def modified(self):
+        return self._items is not None
+
+    def _index(self):
+        if self._offsets is None:
+            data = self._base = self._file.data
+            offsets = array.array('q')
+            if data:
+                offsets.append(0)
+                offsets.extend(
+                    match.end() for match in _newline.finditer(data)
+                )
+            self._offsets = offsets
+        return self._offsets
+
+    def _base_line(self, index):
+        offsets = self._offsets
+        start = offsets[index]
+        if index + 1 < len(offsets):
+            return self._base[start:offsets[index + 1] - 1]
+        return self._base[start:]
+
+    def _line(self, item):
+        return item if isinstance(item, str) else self._base_line(item)
+
+    def _modify(self):
+        if self._items is None:
+            self._items = list(range(len(self._index())))
+        file = self._file
+        file._changed = True
+        _set_dirty(file)
+        return self._items
+
+    def __len__(self):
+        if self._items is not None:
+            return len(self._items)
+        return len(self._index())
+
+    def __getitem__(self, index):
+        if self._items is not None:
+            items = self._items
+        else:
+            items = range(len(self._index()))
+        if isinstance(index, slice):
+            return [self._line(item) for item in items[index]]
+        return self._line(items[index])
+
+    def __iter__(self):
+        if self._items is not None:
+            for item in self._items:
+                yield self._line(item)
+            return
+        for index in range(len(self._index())):
+            yield self._base_line(index)
+
+    def __setitem__(self, index, value):
+        items = self._modify()
+        if isinstance(index, slice):
+            items[index] = [_check_line(line) for line in value]
+        else:
+            items[index] = _check_line(value)
+
+    def __delitem__(self, index):
+        del self._modify()[index]
+
+    def insert(self, index, value):
+        self._modify().insert(index, _check_line(value))
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, _LinesView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __add__(self, other):
+        if isinstance(other, (list, _LinesView)):
+            return list(self) + list(other)
+        return NotImplemented
+
+    def __radd__(self, other):
+        if isinstance(other, list):
+            return other + list(self)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def copy(self):
+        """Return lines as list, which is detached from the file."""
+        return list(self)
+
+    def serialize(self):
+        return '\n'.join(self)
+
+
+class _ChainedReader(io.RawIOBase):
+    """Raw binary stream reading from file objects one after another."""
+
+    def __init__(self, sources):
+        self._sources = collections.deque(sources)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        sources = self._sources
+        while sources:
+            data = sources[0].read(len(buffer))
+            if data:
+                size = len(data)
+                buffer[:size] = data
+                return size
+            sources.popleft().close()
+        return 0
+
+    def close(self):
+        sources = self._sources
+        while sources:
+            sources.popleft().close()
+        super(_ChainedReader, self).close()
+
+
+def _check_line(line):
+    if not isinstance(line, str):
+        raise TypeError('Lines must be strings, got {!r}'.format(line))
+    return line
+
+
+_newline = re.compile('\n')
 
 
 @implementer(IFile)
-class FileStorage(DictStorage, _FSModeMixin):
+class FileStorage(DictStorage, _FSPathMixin, _FSModeMixin):
     direct_sync = default(False)
+    atomic_write = default(False)
+    skip_identical_writes = default(False)
 
     @property
     def mode(self):
@@ -72,16 +2045,41 @@ class FileStorage(DictStorage, _FSModeMixin):
 
     @property
     def data(self):
+        if hasattr(self, '_stream'):
+            self._data = self._read_stream()
+        if hasattr(self, '_lines') and self._lines.modified:
+            self._data = self._lines.serialize()
+            self._lines._reset()
         if not hasattr(self, '_data'):
-            if self.mode == MODE_BINARY:
-                self._data = None
-            else:
-                self._data = ''
-            file_path = os.path.join(*_fs_path(self))
-            if os.path.exists(file_path):
-                mode = self.mode == MODE_BINARY and 'rb' or 'r'
-                with open(file_path, mode) as file:
+            mode = self.mode
+            binary = mode in (MODE_BINARY, MODE_MMAP)
+            self._data = None if binary else ''
+            try:
+                with _opened_parent(self) as dir_fd:
+                    file = _sys.open(
+                        _fs_target(self, dir_fd),
+                        binary and 'rb' or 'r',
+                        dir_fd=dir_fd
+                    )
+            except (FileNotFoundError, NotADirectoryError):
+                if hasattr(self, '_appended'):
+                    self._data = (b'' if binary else '').join(self._appended)
+                return self._data
+            with file:
+                # remember signature of loaded data for ``refresh``
+                self._stat_sig = _load_signature(_sys.fstat(file.fileno()))
+                if mode == MODE_MMAP:
+                    self._data = self._map_data(file)
+                else:
                     self._data = file.read()
+                if self.skip_identical_writes:
+                    self._digest = _content_digest(self._data)
+            # pending appended data is not written yet
+            if hasattr(self, '_appended'):
+                self._data += (b'' if binary else '').join(self._appended)
+            cache = getattr(self.__parent__, '_child_cache', None)
+            if cache is not None:
+                cache.loaded(self, len(self._data))
         return self._data
 
     @default
@@ -89,46 +2087,309 @@ class FileStorage(DictStorage, _FSModeMixin):
     def data(self, data):
         setattr(self, '_changed', True)
         self._data = data
+        if hasattr(self, '_appended'):
+            del self._appended
+        if hasattr(self, '_lines'):
+            self._lines._reset()
+        _set_dirty(self)
+
+    @default
+    def _read_stream(self):
+        stream = self._stream
+        del self._stream
+        if hasattr(stream, 'read'):
+            return stream.read()
+        empty = b'' if self.mode in (MODE_BINARY, MODE_MMAP) else ''
+        return empty.join(stream)
+
+    @default
+    def open_read(self):
+        binary = self.mode in (MODE_BINARY, MODE_MMAP)
+        # pending changes are read from memory
+        if hasattr(self, '_changed') \
+                or (hasattr(self, '_appended') and hasattr(self, '_data')):
+            data = self.data
+            if binary:
+                return io.BytesIO(data or b'')
+            return io.StringIO(data)
+        if hasattr(self, '_appended'):
+            return self._open_appended(binary)
+        try:
+            with _opened_parent(self) as dir_fd:
+                return _sys.open(
+                    _fs_target(self, dir_fd),
+                    binary and 'rb' or 'r',
+                    dir_fd=dir_fd
+                )
+        except FileNotFoundError:
+            return binary and io.BytesIO(b'') or io.StringIO('')
+
+    @default
+    def _open_appended(self, binary):
+        # read file contents from disk followed by pending appended chunks
+        sources = list()
+        try:
+            with _opened_parent(self) as dir_fd:
+                sources.append(_sys.open(
+                    _fs_target(self, dir_fd),
+                    'rb',
+                    dir_fd=dir_fd
+                ))
+        except FileNotFoundError:
+            pass
+        # text is encoded and decoded with the default encoding of ``open``
+        encoding = locale.getpreferredencoding(False)
+        if binary:
+            pending = b''.join(self._appended)
+        else:
+            pending = ''.join(self._appended).encode(encoding)
+        sources.append(io.BytesIO(pending))
+        reader = io.BufferedReader(_ChainedReader(sources))
+        if binary:
+            return reader
+        return io.TextIOWrapper(reader, encoding=encoding)
+
+    @default
+    def iter_chunks(self, size=io.DEFAULT_BUFFER_SIZE * 8):
+        with self.open_read() as file:
+            while True:
+                chunk = file.read(size)
+                if not chunk:
+                    break
+                yield chunk
+
+    @default
+    def iter_lines(self):
+        if self.mode in (MODE_BINARY, MODE_MMAP):
+            raise RuntimeError('Cannot read lines from binary file.')
+        # same result as ``lines``, but without reading the whole file
+        newline = False
+        with self.open_read() as file:
+            for line in file:
+                newline = line.endswith('\n')
+                yield newline and line[:-1] or line
+        if newline:
+            yield ''
+
+    @default
+    def write_from(self, source):
+        self._release_data()
+        if hasattr(self, '_data'):
+            del self._data
+        if hasattr(self, '_lines'):
+            self._lines._reset()
+        if hasattr(self, '_appended'):
+            del self._appended
+        self._stream = source
+        self._changed = True
+        _set_dirty(self)
+
+    @default
+    def append(self, data):
+        if hasattr(self, '_changed') or self.mode == MODE_MMAP:
+            # whole file gets written anyway
+            current = self.data
+            if current is None:
+                current = data[:0]
+            elif self.mode == MODE_MMAP:
+                current = bytes(current)
+            self.data = current + data
+            return
+        if not hasattr(self, '_appended'):
+            self._appended = list()
+        self._appended.append(data)
+        if hasattr(self, '_data'):
+            self._data = (self._data or data[:0]) + data
+        if hasattr(self, '_lines'):
+            self._lines._reset()
+        _set_dirty(self)
+
+    @default
+    def _map_data(self, file):
+        try:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            return b''
+        self._mmap_view = memoryview(self._mmap)
+        return self._mmap_view
+
+    @default
+    def _release_data(self):
+        """Drop loaded data and close memory mapping if present."""
+        if hasattr(self, '_mmap'):
+            mapped = self._mmap
+            view = self._mmap_view
+            del self._mmap, self._mmap_view
+            if getattr(self, '_data', None) is view:
+                del self._data
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # slices of the data are still referenced somewhere, the
+                # mapping gets closed when they are garbage collected
+                pass
+        if not hasattr(self, '_changed') and hasattr(self, '_data'):
+            del self._data
+            if hasattr(self, '_stat_sig'):
+                del self._stat_sig
+            if hasattr(self, '_digest'):
+                del self._digest
+            if hasattr(self, '_lines'):
+                self._lines._reset()
+
+    @default
+    @locktree
+    def refresh(self):
+        try:
+            with _opened_parent(self) as dir_fd:
+                st = _sys.stat(_fs_target(self, dir_fd), dir_fd=dir_fd)
+        except OSError:
+            st = None
+        _refresh_fs_mode(self, st)
+        # drop loaded data if changed on disk, it gets reloaded on access
+        if hasattr(self, '_stat_sig') \
+                and self._stat_sig != _stat_signature(st):
+            self._release_data()
 
     @property
     def lines(self):
-        if self.mode == MODE_BINARY:
+        if self.mode in (MODE_BINARY, MODE_MMAP):
             raise RuntimeError('Cannot read lines from binary file.')
-        if not self.data:
-            return []
-        return self.data.split('\n')
+        if not hasattr(self, '_lines'):
+            self._lines = _LinesView(self)
+        return self._lines
 
     @default
     @lines.setter
     def lines(self, lines):
-        if self.mode == MODE_BINARY:
+        if self.mode in (MODE_BINARY, MODE_MMAP):
             raise RuntimeError('Cannot write lines to binary file.')
         self.data = '\n'.join(lines)
 
-    @default
-    @property
-    def fs_path(self):
-        # seems more appropriate here:
-        #     return self.parent.fs_path + [self.name]
-        return self.path
-
     @finalize
     @locktree
     def __call__(self):
-        file_path = os.path.join(*_fs_path(self))
-        exists = os.path.exists(file_path)
+        context = _PersistContext()
+        self._persist(context)
+        context.sync_directories()
+        self.persist_stats = context.stats
+
+    @default
+    def _persist(self, context):
+        context.remember(self)
+        with context.opened_parent(self) as dir_fd:
+            self._persist_file(context, _fs_target(self, dir_fd), dir_fd)
+        self._dirty = False
+
+    @default
+    def _persist_file(self, context, file_path, dir_fd):
+        # ``file_path`` is relative to ``dir_fd`` if given
+        changed = hasattr(self, '_changed')
+        appended = hasattr(self, '_appended')
+        # Only write appended data if file has not been changed otherwise
+        if appended and not changed and not self.atomic_write:
+            write_mode = self.mode == MODE_BINARY and 'ab' or 'a'
+            context.write_file(
+                file_path,
+                write_mode,
+                self._write_appended,
+                sync=self.direct_sync,
+                dir_fd=dir_fd
+            )
+            del self._appended
+            if self.direct_sync:
+                context.sync_directory(self._dir_path(), self.__parent__)
+            written = True
+        # Skip writing if data equals the file contents if desired
+        elif changed and not appended and self.skip_identical_writes \
+                and self._identical_on_disk(file_path, dir_fd=dir_fd):
+            del self._changed
+            context.count('suppressed')
+            written = False
         # Only write file if it's data has changed or not exists yet
-        if hasattr(self, '_changed') or not exists:
-            write_mode = self.mode == MODE_BINARY and 'wb' or 'w'
-            with open(file_path, write_mode) as file:
-                file.write(self.data)
-                if self.direct_sync:
-                    file.flush()
-                    os.fsync(file.fileno())
+        elif changed or appended \
+                or not context.exists(file_path, dir_fd=dir_fd):
+            mode = self.mode
+            write_mode = mode in (MODE_BINARY, MODE_MMAP) and 'wb' or 'w'
+            # Memory mapped files are always replaced atomically. Truncating
+            # a file while it is mapped somewhere causes bus errors.
+            atomic = self.atomic_write or mode == MODE_MMAP
+            context.write_file(
+                file_path,
+                write_mode,
+                self._write_data,
+                sync=self.direct_sync,
+                atomic=atomic,
+                dir_fd=dir_fd
+            )
+            if hasattr(self, '_mmap'):
+                self._release_data()
+            if self.direct_sync or atomic:
+                context.sync_directory(self._dir_path(), self.__parent__)
+            if changed:
+                del self._changed
+            if hasattr(self, '_appended'):
+                del self._appended
+            written = True
+        else:
+            written = False
         # Change file system mode if set
-        fs_mode = self.fs_mode
-        if fs_mode is not None:
-            os.chmod(file_path, fs_mode)
+        if hasattr(self, '_fs_mode_changed'):
+            fs_mode = self.fs_mode
+            if fs_mode is not None:
+                context.chmod(file_path, fs_mode, dir_fd=dir_fd)
+            del self._fs_mode_changed
+            written = True
+        if written:
+            context.count('written')
+
+    @default
+    def _dir_path(self):
+        # path of the containing directory
+        return os.path.dirname(_fs_join(self))
+
+    @default
+    def _identical_on_disk(self, file_path, dir_fd=None):
+        # Check whether data equals the file contents. The digest remembered
+        # when loading is used if the file has not changed since.
+        if hasattr(self, '_stream'):
+            return False
+        data = self.data
+        if data is None:
+            return False
+        try:
+            st = _sys.stat(file_path, dir_fd=dir_fd)
+        except OSError:
+            return False
+        binary = self.mode in (MODE_BINARY, MODE_MMAP)
+        if binary and st.st_size != len(data):
+            return False
+        digest = getattr(self, '_digest', None)
+        if digest is None \
+                or getattr(self, '_stat_sig', None) != _stat_signature(st):
+            digest = _file_digest(file_path, binary, dir_fd=dir_fd)
+        return digest == _content_digest(data)
+
+    @default
+    def _write_appended(self, file):
+        for chunk in self._appended:
+            file.write(chunk)
+
+    @default
+    def _write_data(self, file):
+        if not hasattr(self, '_stream'):
+            file.write(self.data)
+            return
+        # the stream gets consumed, data is read from disk afterwards
+        stream = self._stream
+        del self._stream
+        if hasattr(stream, 'read'):
+            shutil.copyfileobj(stream, file)
+            return
+        for chunk in stream:
+            file.write(chunk)
 
 
 @plumbing(
@@ -141,18 +2402,120 @@ class File(object):
     pass
 
 
+class FactoryRegistry(dict):
+    """Dict for file factories which counts its modifications.
+
+    Used to detect changes of the registry without comparing the keys.
+    """
+    version = 0
+
+    def _modified(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        super(FactoryRegistry, self).__setitem__(key, value)
+        self._modified()
+
+    def __delitem__(self, key):
+        super(FactoryRegistry, self).__delitem__(key)
+        self._modified()
+
+    def __ior__(self, other):
+        result = super(FactoryRegistry, self).__ior__(other)
+        self._modified()
+        return result
+
+    def clear(self):
+        super(FactoryRegistry, self).clear()
+        self._modified()
+
+    def pop(self, *args):
+        result = super(FactoryRegistry, self).pop(*args)
+        self._modified()
+        return result
+
+    def popitem(self):
+        result = super(FactoryRegistry, self).popitem()
+        self._modified()
+        return result
+
+    def setdefault(self, key, default=None):
+        result = super(FactoryRegistry, self).setdefault(key, default)
+        self._modified()
+        return result
+
+    def update(self, *args, **kw):
+        super(FactoryRegistry, self).update(*args, **kw)
+        self._modified()
+
+
+def _registry_signature(registry):
+    # Signature used to detect changes of a factory registry
+    if isinstance(registry, FactoryRegistry):
+        return (id(registry), registry.version)
+    return (id(registry), tuple(registry))
+
+
+class _FactoryMatcher(object):
+    """Precompiled lookup of file factory keys for child names.
+
+    Endings are looked up by the child name suffix for each distinct ending
+    length, longest first. On equal length local endings take precedence.
+    Regular expression keys are searched in the child name if no ending
+    matches, local before global ones.
+    """
+
+    def __init__(self, local, global_):
+        self.endings = dict()
+        self.patterns = list()
+        for registry in (global_, local):
+            for key in registry:
+                # empty endings never match
+                if key and not isinstance(key, re.Pattern):
+                    self.endings[key] = registry
+        for registry in (local, global_):
+            for key in registry:
+                if isinstance(key, re.Pattern):
+                    self.patterns.append((key, registry))
+        self.lengths = sorted(
+            set(len(key) for key in self.endings),
+            reverse=True
+        )
+
+    def __call__(self, name):
+        """Return factory for name or ``None``."""
+        endings = self.endings
+        size = len(name)
+        for length in self.lengths:
+            if length > size:
+                continue
+            key = name[size - length:]
+            registry = endings.get(key)
+            if registry is not None:
+                return registry[key]
+        for pattern, registry in self.patterns:
+            if pattern.search(name):
+                return registry[pattern]
+
+
 # global file factories
-file_factories = dict()
+file_factories = FactoryRegistry()
 
 
 @implementer(IDirectory)
-class DirectoryStorage(DictStorage, _FSModeMixin):
+class DirectoryStorage(DictStorage, _FSPathMixin, _FSModeMixin):
     fs_encoding = default('utf-8')
     ignores = default(list())
+    cache_max_entries = default(None)
+    cache_max_bytes = default(None)
+    flush_executor = default(None)
+    transactional = default(False)
+    index_path = default(None)
+    max_open_dirs = default(None)
     default_file_factory = default(File)
 
     # XXX: rename later to file_factories, keep now as is for B/C reasons
-    factories = default(dict())
+    factories = default(FactoryRegistry())
 
     @default
     @property
@@ -165,13 +2528,10 @@ class DirectoryStorage(DictStorage, _FSModeMixin):
     def child_directory_factory(self):
         return Directory
 
-    @default
-    @property
-    def fs_path(self):
-        return self.path
-
     @finalize
-    def __init__(self, name=None, parent=None, backup=False, factories=dict()):
+    def __init__(self, name=None, parent=None, backup=False, factories=dict(),
+                 cache_max_entries=None, cache_max_bytes=None,
+                 max_open_dirs=None):
         self.__name__ = name
         self.__parent__ = parent
         if backup or hasattr(self, 'backup'):
@@ -180,41 +2540,112 @@ class DirectoryStorage(DictStorage, _FSModeMixin):
                 'implementation as of node.ext.directory 0.7')
         # override file factories if given
         if factories:
-            self.factories = factories
-        self._deleted = list()
+            _set_setting(self, 'factories', factories)
+        self._deleted = _DeletedNames()
+        self._listing = dict()
+        # bound number of cached children and loaded file data if desired
+        if cache_max_entries is not None:
+            _set_setting(self, 'cache_max_entries', cache_max_entries)
+        if cache_max_bytes is not None:
+            _set_setting(self, 'cache_max_bytes', cache_max_bytes)
+        # set by ``node.ext.directory.watcher.DirectoryWatcher``
+        self._watcher = None
+        self._child_cache = None
+        if self.cache_max_entries is not None \
+                or self.cache_max_bytes is not None:
+            self._child_cache = _ChildCache(
+                max_entries=self.cache_max_entries,
+                max_bytes=self.cache_max_bytes
+            )
+        # make file system calls relative to opened directories if desired
+        if max_open_dirs is not None:
+            _set_setting(self, 'max_open_dirs', max_open_dirs)
+        self._dir_fds = None
+        if self.max_open_dirs is not None and _dir_fd_supported:
+            self._dir_fds = _DirFDCache(self.max_open_dirs)
 
     @finalize
     @locktree
-    def __call__(self):
-        if IDirectory.providedBy(self):
-            dir_path = os.path.join(*self.fs_path)
-            if os.path.exists(dir_path) and not os.path.isdir(dir_path):
-                raise KeyError(
-                    'Attempt to create a directory with name which already '
-                    'exists as file')
+    def __call__(self, workers=None):
+        executor = self.flush_executor
+        if workers:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            if self.transactional:
+                dir_path = _fs_join(self)
+                context = _TransactionContext(dir_path, executor=executor)
+            else:
+                context = _PersistContext(executor=executor)
             try:
-                os.mkdir(dir_path)
-            except OSError as e:
-                # Ignore ``already exists``.
-                if e.errno != 17:
-                    raise e                                   # pragma no cover
-            # Change file system mode if set
-            fs_mode = self.fs_mode
-            if fs_mode is not None:
-                os.chmod(dir_path, fs_mode)
-        while self._deleted:
-            name = self._deleted.pop()
-            abs_path = os.path.join(*self.fs_path + [name])
-            if os.path.exists(abs_path):
-                if os.path.isdir(abs_path):
-                    shutil.rmtree(abs_path)
-                else:
-                    os.remove(abs_path)
-        for name, target in self.items():
+                try:
+                    self._persist(context)
+                finally:
+                    # wait for pending files also if persisting failed
+                    errors = context.wait()
+                if errors:
+                    raise PersistError(errors)
+                context.commit()
+            except BaseException:
+                context.rollback()
+                raise
+            finally:
+                context.sync_directories()
+                context.close()
+                self.persist_stats = context.stats
+            if self.index_path is not None:
+                self.save_index()
+        finally:
+            if workers:
+                executor.shutdown()
+
+    @default
+    def _persist(self, context):
+        context.remember(self)
+        if IDirectory.providedBy(self):
+            with context.opened_parent(self) as dir_fd:
+                dir_path = _fs_target(self, dir_fd)
+                if context.mkdir(dir_path, dir_fd=dir_fd):
+                    context.count('written')
+                # Change file system mode if set
+                if hasattr(self, '_fs_mode_changed'):
+                    fs_mode = self.fs_mode
+                    if fs_mode is not None:
+                        context.chmod(dir_path, fs_mode, dir_fd=dir_fd)
+                    del self._fs_mode_changed
+                    context.count('written')
+        if self._deleted:
+            # names which failed to delete are kept for the next run
+            deleted = self._deleted
+            listing = self._listing
+            entries = [(name, listing.pop(name, None)) for name in deleted]
+            count, failed = context.delete_entries(
+                self,
+                _fs_join(self),
+                entries
+            )
+            deleted.clear()
+            deleted.extend(failed)
+            context.count('deleted', count)
+        # Only loaded children may be changed, clean subtrees get skipped.
+        # Directories are persisted in order, files by executor if given.
+        # Nodes not providing ``_persist`` do not track changes, directories
+        # containing such nodes stay dirty to get them called next time.
+        dirty = False
+        for target in list(self.storage.values()):
+            if not _is_dirty(target):
+                continue
             if IDirectory.providedBy(target):
-                target()
+                _persist_child(target, context)
+                dirty = dirty or _is_dirty(target)
             elif IFile.providedBy(target):
-                target()
+                if context.executor is not None \
+                        and hasattr(target, '_persist'):
+                    context.submit(target)
+                else:
+                    _persist_child(target, context)
+            if not hasattr(target, '_persist'):
+                dirty = True
+        self._dirty = dirty
 
     @finalize
     def __setitem__(self, name, value):
@@ -222,7 +2653,27 @@ class DirectoryStorage(DictStorage, _FSModeMixin):
             raise KeyError('Empty key not allowed in directories')
         name = self._encode_name(name)
         if IFile.providedBy(value) or IDirectory.providedBy(value):
+            cache = self._child_cache
+            if cache is not None:
+                existing = self.storage.get(name)
+                if existing is not None:
+                    cache.discard(existing)
+                if IDirectory.providedBy(value):
+                    value._child_cache = cache
+            if self._watcher is not None and IDirectory.providedBy(value):
+                value._watcher = self._watcher
+            if IDirectory.providedBy(value) \
+                    and getattr(value, '_fs_path_memo', None) is not None:
+                # directory gets moved, memoized paths of children are stale
+                global _path_epoch
+                _path_epoch += 1
+            if self._dir_fds is not None and IDirectory.providedBy(value):
+                # descriptors opened at a former location are invalid
+                _close_dir_fds(value)
+                value._dir_fds = self._dir_fds
             self.storage[name] = value
+            if _is_dirty(value):
+                _set_dirty(self)
             # XXX: This event is currently used in node.ext.zcml and
             #      node.ext.python to trigger parsing. But this behavior
             #      requires the event to be triggered on __getitem__ which is
@@ -238,60 +2689,371 @@ class DirectoryStorage(DictStorage, _FSModeMixin):
     def __getitem__(self, name):
         name = self._encode_name(name)
         try:
-            return self.storage[name]
+            child = self.storage[name]
         except KeyError:
             self._create_child_by_factory(name)
-        return self.storage[name]
+            return self.storage[name]
+        cache = self._child_cache
+        if cache is not None:
+            cache.touch(child)
+        return child
 
     @default
     @locktree
     def _create_child_by_factory(self, name):
-        filepath = os.path.join(*self.fs_path + [name])
-        if not os.path.exists(filepath):
-            return
-        if os.path.isdir(filepath):
-            # XXX: to suppress event notify
-            self[name] = self.child_directory_factory()
-            return
+        # use entry from last directory listing if present, otherwise stat
+        entry = self._listing.get(name)
+        if entry is None:
+            entry = self._stat_child(name, _listing_entry)
+            if entry is None:
+                return
+        if entry.is_dir:
+            child = self.child_directory_factory()
+        else:
+            child = self._create_file_by_factory(name)
+        if entry.stat is not None:
+            child._fs_mode = entry.stat.st_mode & 0o777
+        # children created from the file system are in sync with it. Nodes
+        # not providing ``_persist`` do not track changes and are always dirty
+        if hasattr(child, '_persist'):
+            child._dirty = False
+        # XXX: to suppress event notify
+        self[name] = child
+        cache = self._child_cache
+        if cache is not None:
+            cache.add(child)
+
+    @default
+    def _stat_child(self, name, entry_factory):
+        # Create listing entry for child name by calling ``entry_factory``
+        # with path and ``dir_fd``
+        if self._dir_fds is None:
+            return entry_factory(os.path.join(_fs_join(self), name))
+        try:
+            with self._dir_fds.opened(self) as dir_fd:
+                return entry_factory(name, dir_fd=dir_fd)
+        except OSError:
+            return None
+
+    @default
+    def _create_file_by_factory(self, name):
         factory = self._factory_for_ending(name)
         if not factory:
-            # XXX: to suppress event notify
-            self[name] = self.default_file_factory()
-            return
+            return self.default_file_factory()
         try:
-            # XXX: to suppress event notify
-            self[name] = factory()
+            return factory()
         except TypeError as e:
             # happens if the factory cannot be called without args, in this
             # case we treat it as a flat file.
-            # XXX: to suppress event notify
             logger.error(
                 'File creation by factory failed. Fall back to ``File``. '
                 'Reason: {}'.format(e))
-            self[name] = File()
+            return File()
 
     @finalize
     def __delitem__(self, name):
         name = self._encode_name(name)
-        if os.path.exists(os.path.join(*self.fs_path + [name])):
+        # names from last directory listing need no stat call. The type of
+        # other entries is remembered in the listing for deleting them on
+        # ``__call__``.
+        listing = self._listing
+        exists = name in listing
+        if not exists:
+            entry = self._stat_child(name, _delete_entry)
+            exists = entry is not None
+            if exists and not entry.is_link:
+                listing[name] = entry
+        if exists:
             self._deleted.append(name)
+            _set_dirty(self)
+        elif name not in self.storage:
+            raise KeyError(name)
+        child = self.storage.pop(name, None)
+        if child is not None:
+            if self._child_cache is not None:
+                self._child_cache.discard(child)
+            _close_dir_fds(child)
+
+    @default
+    @locktree
+    def delete_many(self, names):
+        names = list(dict.fromkeys(self._encode_name(name) for name in names))
+        # a single directory scan replaces a stat call per name
+        if not hasattr(self, '_listing_sig'):
+            self._scan()
+        listing = self._listing
+        storage = self.storage
+        existing = list()
+        missing = list()
+        for name in names:
+            if name not in listing:
+                entry = self._stat_child(name, _delete_entry)
+                if entry is None:
+                    if name not in storage:
+                        missing.append(name)
+                    continue
+                if not entry.is_link:
+                    listing[name] = entry
+            existing.append(name)
+        if missing:
+            raise KeyError(*missing)
+        for name in names:
+            if name in storage:
+                self._drop_child(name)
+        if existing:
+            self._deleted.extend(existing)
+            _set_dirty(self)
+
+    @default
+    @locktree
+    def refresh(self):
+        try:
+            with _opened_parent(self) as dir_fd:
+                st = _sys.stat(_fs_target(self, dir_fd), dir_fd=dir_fd)
+        except OSError:
+            st = None
+        _refresh_fs_mode(self, st)
+        # rescan only if directory changed on disk, drop unmodified children
+        # which are gone or changed their type
+        if getattr(self, '_listing_sig', None) != _stat_signature(st):
+            # opened descriptor might refer to a replaced directory
+            if self._dir_fds is not None:
+                self._dir_fds.discard(self)
+            self._scan()
+            listing = self._listing
+            for name, child in list(self.storage.items()):
+                if _is_dirty(child):
+                    continue
+                entry = listing.get(name)
+                if entry is None \
+                        or entry.is_dir != IDirectory.providedBy(child):
+                    self._drop_child(name)
+        for child in list(self.storage.values()):
+            if hasattr(child, 'refresh'):
+                child.refresh()
+
+    @default
+    def _scan(self):
+        """Scan directory, remember listing and its stat signature.
+
+        Return names of all directory entries.
+        """
+        index = self._snapshot_index()
+        if self._dir_fds is not None and index is None:
+            # scan opened directory
+            try:
+                with self._dir_fds.opened(self) as dir_fd:
+                    st = _sys.fstat(dir_fd)
+                    self._listing_sig = _load_signature(st)
+                    names, self._listing = _scan_directory(dir_fd)
+            except OSError:
+                self._listing_sig = _load_signature(None)
+                names, self._listing = list(), dict()
+        else:
+            dir_path = _fs_join(self)
+            # stat before scanning, changes in between get detected on next
+            # scan
+            try:
+                st = _sys.stat(dir_path)
+            except OSError:
+                st = None
+            self._listing_sig = _load_signature(st)
+            indexed = None
+            if index is not None:
+                indexed = index.listing(dir_path, st)
+            if indexed is not None:
+                names, self._listing = indexed
+            else:
+                names, self._listing = _scan_directory(dir_path)
+        # watched directories keep the listing until the watcher reports
+        # changes
+        if self._watcher is not None:
+            self._names = names
+            self._listing_watched = True
+        return names
+
+    @default
+    def _snapshot_index(self):
+        # Snapshot index of the tree, loaded on first access if
+        # ``index_path`` is set on the root directory
+        root = self
+        while IDirectory.providedBy(root.__parent__):
+            root = root.__parent__
+        index = getattr(root, '_snapshot', None)
+        if index is None:
+            index_path = root.index_path
+            if index_path is None:
+                return None
+            index = _SnapshotIndex.load(
+                index_path,
+                _fs_join(root)
+            )
+            # remember failed loading
+            root._snapshot = index = index if index is not None else False
+        return index or None
+
+    @default
+    def save_index(self, index_path=None):
+        if index_path is None:
+            index_path = self.index_path
+        if index_path is None:
+            raise ValueError('No index path given')
+        self._snapshot = _SnapshotIndex.write(
+            index_path,
+            _fs_join(self),
+            previous=self._snapshot_index()
+        )
+
+    @override
+    @property
+    def _referencable_child_nodes(self):
+        # Only loaded children are referenced. Unloaded children get added to
+        # the reference index when created, this avoids loading the whole
+        # subtree when adding a directory to the tree.
+        for child in self.storage.values():
+            if INodeReference.providedBy(child):
+                yield child
+
+    @override
+    def _update_reference_index(self, value):
+        # Check colliding uuids by lookups in own index instead of building a
+        # set of the whole index, which made loading children quadratic.
+        if INodeReference.providedBy(value):
+            index = self._index
+            colliding = set(key for key in value._index if key in index)
+            if colliding:
+                raise IndexViolationError(
+                    (
+                        'Given node or members of it provide uuid(s) '
+                        'colliding with own index.'
+                    ),
+                    colliding
+                )
+            index.update(value._index)
+
+            def _set_index(node):
+                node._index = index
+                for child in node._referencable_child_nodes:
+                    _set_index(child)
+            _set_index(value)
+
+    @default
+    def _drop_child(self, name):
+        """Remove child from memory without deleting it on disk."""
+        child = self.storage[name]
+        cache = self._child_cache
+        if cache is not None:
+            cache.discard(child)
+        _release(child)
+        if INodeReference.providedBy(self):
+            self._reduce_reference_index(child)
         del self.storage[name]
 
     @finalize
     def __iter__(self):
-        try:
-            existing = set(os.listdir(os.path.join(*self.fs_path)))
-        except OSError:
-            existing = set()
+        if getattr(self, '_listing_watched', False):
+            existing = set(self._names)
+        else:
+            existing = set(self._scan())
         for key in self.storage:
             existing.add(key)
+        deleted = self._deleted
+        ignores = self._ignore_matcher()
         for key in existing:
-            if key in self._deleted:
+            if key in deleted:
                 continue
-            if key in self.ignores:
+            if key in ignores:
                 continue
             yield key
 
+    @default
+    def _ignore_matcher(self):
+        signature = _ignores_signature(self.ignores)
+        cached = getattr(self, '_ignores_matcher', None)
+        if cached is None or cached[0] != signature:
+            cached = self._ignores_matcher = (
+                signature,
+                _IgnoreMatcher(self.ignores)
+            )
+        return cached[1]
+
+    @default
+    def walk(self, max_depth=None, follow_symlinks=False):
+        """Walk directory tree top-down without creating nodes.
+
+        Yield ``(path, dirnames, filenames)`` tuples, where ``path`` is a
+        tuple of names relative to this directory. ``dirnames`` can be
+        modified in place to prune the walk. Loaded directories are
+        considered with their in-memory changes.
+        """
+        ignores = _ignores_of(self.child_directory_factory)
+        level = ((), self, _fs_join(self))
+        walk = _walk(
+            level,
+            ignores,
+            max_depth,
+            follow_symlinks,
+            index=self._snapshot_index()
+        )
+        for (path, _, _), dirnames, filenames in walk:
+            yield path, dirnames, filenames
+
+    @default
+    def iter_files(self, pattern=None, max_depth=None, nodes=False):
+        """Iterate files of directory tree.
+
+        File names are filtered by ``pattern`` with ``fnmatch`` before any
+        node gets created. Yield tuples of names relative to this directory,
+        or file nodes if ``nodes`` is set.
+        """
+        for path, dirnames, filenames in self.walk(max_depth=max_depth):
+            if pattern is not None:
+                filenames = fnmatch.filter(filenames, pattern)
+            if not filenames:
+                continue
+            if not nodes:
+                for name in filenames:
+                    yield path + (name,)
+                continue
+            directory = self
+            for name in path:
+                directory = directory[name]
+            for name in filenames:
+                yield directory[name]
+
+    @default
+    def glob(self, pattern):
+        """Iterate nodes matching ``pattern`` relative to this directory.
+
+        Pattern parts are separated by ``/`` and matched with ``fnmatch``.
+        ``**`` matches this directory and all subdirectories recursively.
+        Nodes only get created for matches.
+        """
+        parts = [part for part in pattern.split('/') if part]
+        if not parts:
+            raise ValueError('Unacceptable pattern: {0!r}'.format(pattern))
+        ignores = _ignores_of(self.child_directory_factory)
+        level = ((), self, _fs_join(self))
+        seen = set()
+        directory_path, directory = (), self
+        index = self._snapshot_index()
+        for path in _glob(level, parts, ignores, index=index):
+            if path in seen:
+                continue
+            seen.add(path)
+            if path[:-1] != directory_path:
+                directory_path, directory = path[:-1], self
+                for name in directory_path:
+                    directory = directory[name]
+            yield directory[path[-1]]
+
+    @default
+    def rglob(self, pattern):
+        """Iterate nodes matching ``pattern`` in this directory and all
+        subdirectories.
+        """
+        return self.glob('**/' + pattern)
+
     @default
     def _encode_name(self, name):
         name = name.encode(self.fs_encoding) \
@@ -301,25 +3063,19 @@ class DirectoryStorage(DictStorage, _FSModeMixin):
 
     @default
     def _factory_for_ending(self, name):
-        def match(keys, key):
-            keys = sorted(
-                keys,
-                key=lambda x: len(x),
-                reverse=True
+        local = self.file_factories
+        signature = (
+            _registry_signature(local),
+            _registry_signature(file_factories)
+        )
+        cached = getattr(self, '_factory_matcher', None)
+        if cached is None or cached[0] != signature:
+            # rebuild matcher only if one of the registries changed
+            cached = self._factory_matcher = (
+                signature,
+                _FactoryMatcher(local, file_factories)
             )
-            for possible in keys:
-                if key.endswith(possible):
-                    return possible
-        factory_keys = [
-            match(self.file_factories.keys(), name),
-            match(file_factories.keys(), name),
-        ]
-        if factory_keys[0]:
-            if factory_keys[1] and len(factory_keys[1]) > len(factory_keys[0]):
-                return file_factories[factory_keys[1]]
-            return self.file_factories[factory_keys[0]]
-        if factory_keys[1]:
-            return file_factories[factory_keys[1]]
+        return cached[1](name)
 
 
 @plumbing(
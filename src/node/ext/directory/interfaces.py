@@ -7,6 +7,7 @@ from zope.lifecycleevent import IObjectAddedEvent
 
 MODE_TEXT = 0
 MODE_BINARY = 1
+MODE_MMAP = 2
 
 
 class IFileAddedEvent(IObjectAddedEvent):
@@ -22,20 +23,73 @@ class IFile(INode, ILeaf, ICallable):
 
     direct_sync = Attribute(
         'Flag whether to directly sync filesystem with ``os.fsync`` on '
-        '``__call__``'
+        '``__call__``. The containing directory gets synced once per '
+        '``__call__`` as well'
+    )
+
+    atomic_write = Attribute(
+        'Flag whether to write a temporary file on ``__call__`` which gets '
+        'synced and moved to the file path. The containing directory gets '
+        'synced once per ``__call__``'
+    )
+
+    skip_identical_writes = Attribute(
+        'Flag whether to skip writing on ``__call__`` if data equals the file '
+        'contents. A digest of the contents is kept when loading data. '
+        'Skipped writes are counted as ``suppressed`` in ``persist_stats``'
     )
 
     mode = Attribute(
-        'Mode of this file. Either ``MODE_TEXT`` or ``MODE_BINARY``'
+        'Mode of this file. Either ``MODE_TEXT``, ``MODE_BINARY`` or '
+        '``MODE_MMAP``. In ``MODE_MMAP`` data of existing files is a '
+        'read-only ``memoryview`` of the memory mapped file'
     )
 
     data = Attribute('Data of the file')
 
+    persist_stats = Attribute(
+        '``PersistStats`` instance of the last ``__call__``'
+    )
+
     lines = Attribute(
         'Data of the file as list of lines. Can only be used if file mode is '
-        '``MODE_TEXT``'
+        '``MODE_TEXT``. Reading returns a mutable sequence which slices lines '
+        'from the file data on access. Edits on it are joined to file data '
+        'when data is read or the file gets persisted.'
     )
 
+    def open_read():
+        """Return file object for reading the file contents. If data has
+        been changed, the file object reads from memory.
+        """
+
+    def iter_chunks(size=65536):
+        """Iterate file contents in chunks of ``size``."""
+
+    def iter_lines():
+        """Iterate lines of the file without reading the whole file. Can
+        only be used if file mode is ``MODE_TEXT``.
+        """
+
+    def refresh():
+        """Compare the file with the file system. Loaded data gets dropped
+        and is reloaded on next access if modification time, size or inode
+        changed on disk. ``fs_mode`` gets updated if not set explicitly.
+        Modified data is kept.
+        """
+
+    def append(data):
+        """Append ``data`` to the file. If data has not been changed
+        otherwise, only the appended data gets written on ``__call__`` and
+        the existing file contents are not loaded.
+        """
+
+    def write_from(source):
+        """Set file contents from ``source``, which is either an iterable of
+        chunks or a file object. The source gets consumed on ``__call__``
+        and is written to disk in chunks.
+        """
+
 
 class IDirectory(INode, ICallable):
     """Directory interface."""
@@ -46,6 +100,110 @@ class IDirectory(INode, ICallable):
 
     fs_encoding = Attribute('Filesystem encoding. Defaults to UTF-8')
 
+    persist_stats = Attribute(
+        '``PersistStats`` instance of the last ``__call__``. Contains the '
+        'number of written and deleted nodes'
+    )
+
+    flush_executor = Attribute(
+        '``concurrent.futures.Executor`` instance used to persist files on '
+        '``__call__``. Directories are always persisted in order by the '
+        'calling thread. Defaults to ``None``, which means files get '
+        'persisted in order as well'
+    )
+
+    transactional = Attribute(
+        'Flag whether to persist transactionally on ``__call__``. Files get '
+        'written to a staging directory next to the directory first. Then '
+        'deletes, directory creation, moving the staged files in place and '
+        'file mode changes are applied in order. Applied changes get rolled '
+        'back if applying fails. Data of ``write_from`` sources consumed by '
+        'the failed run is loaded from the staged file. Sources which could '
+        'not be staged completely raise a ``RuntimeError`` on next '
+        '``__call__``'
+    )
+
+    index_path = Attribute(
+        'Path of a snapshot index file containing names, types, sizes, '
+        'modification times and modes of the directory tree entries. If set '
+        'on the root directory, the index is loaded on first directory '
+        'listing and listings of directories which have not been modified '
+        'since the index was written are taken from it. The index gets '
+        'written on ``__call__``. Defaults to ``None``'
+    )
+
+    max_open_dirs = Attribute(
+        'Maximum number of directory file descriptors kept open for the whole '
+        'tree. If set, directories get opened relative to their parent '
+        'directory and file system calls of children are made relative to '
+        'the opened directory instead of resolving the path from root. Least '
+        'recently used descriptors get closed. The tree must not be moved on '
+        'disk while descriptors are open. Defaults to ``None``, which means '
+        'file system calls use paths'
+    )
+
+    def save_index(index_path=None):
+        """Scan the directory tree and write snapshot index to
+        ``index_path`` or ``self.index_path``. Directories which have not
+        been modified since the loaded index was written are not rescanned.
+        """
+
+    def delete_many(names):
+        """Delete children by ``names``. Names get looked up in the directory
+        listing, which is scanned once if not present. ``KeyError`` is raised
+        if a name does not exist, in this case nothing gets deleted.
+
+        Entries are removed from disk on ``__call__``. Files and symlinks are
+        unlinked relative to the opened directory, subdirectories of deleted
+        directories are removed in parallel if an executor is used. Errors
+        are reported per entry by ``PersistError``, failed entries are
+        deleted again on next ``__call__``.
+        """
+
+    def refresh():
+        """Compare the directory and its loaded children with the file
+        system. The directory gets rescanned only if it changed on disk.
+        Unmodified children which no longer exist or changed their type are
+        dropped.
+        """
+
+    def walk(max_depth=None, follow_symlinks=False):
+        """Walk directory tree top-down without creating child nodes.
+
+        Yield ``(path, dirnames, filenames)`` tuples, where ``path`` is a
+        tuple of names relative to this directory. ``dirnames`` can be
+        modified in place to prune the walk. Symlinked directories are only
+        descended if ``follow_symlinks`` is set.
+        """
+
+    def iter_files(pattern=None, max_depth=None, nodes=False):
+        """Iterate files of directory tree.
+
+        File names are filtered by ``fnmatch`` style ``pattern``. Yield
+        tuples of names relative to this directory, or file nodes if
+        ``nodes`` is set. Nodes only get created for matching files.
+        """
+
+    def glob(pattern):
+        """Iterate child nodes matching ``pattern`` relative to this
+        directory. Pattern parts are separated by ``/`` and matched with
+        ``fnmatch``. ``**`` matches this directory and all subdirectories.
+        Nodes only get created for matches.
+        """
+
+    def rglob(pattern):
+        """Iterate child nodes matching ``pattern`` in this directory and all
+        subdirectories.
+        """
+
+    def __call__(workers=None):
+        """Persist directory and all modified children.
+
+        If ``workers`` is given, files are persisted in parallel by a thread
+        pool with the given number of workers. ``PersistError`` is raised
+        after all files have been processed if persisting files failed.
+        """
+
     child_directory_factory = Attribute(
         'Factory creating concrete node instances for directory children'
     )
@@ -56,7 +214,26 @@ class IDirectory(INode, ICallable):
 
     file_factories = Attribute(
         'Dict containing file names or endings as keys with the corresponding '
-        'file node creating factory.'
+        'file node creating factory. Keys can also be compiled regular '
+        'expressions, which are searched in the file name if no ending '
+        'matches.'
+    )
+
+    ignores = Attribute(
+        'Child keys to ignore. Either exact names, ``fnmatch`` style '
+        'patterns like ``*.pyc`` or compiled regular expressions, which are '
+        'searched in the child name.'
     )
 
-    ignores = Attribute('child keys to ignore')
+    cache_max_entries = Attribute(
+        'Maximum number of children created from the file system kept in '
+        'memory for the whole tree. Least recently used unmodified children '
+        'get evicted and are reloaded on next access. Defaults to ``None``, '
+        'which means unbounded'
+    )
+
+    cache_max_bytes = Attribute(
+        'Maximum size of loaded file data kept in memory for the whole tree. '
+        'Least recently used unmodified files get evicted and are reloaded on '
+        'next access. Defaults to ``None``, which means unbounded'
+    )
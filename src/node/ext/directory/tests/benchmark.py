@@ -0,0 +1,305 @@
+"""Benchmarks for directory and file hot paths.
+
+Run with::
+
+    python src/node/ext/directory/tests/benchmark.py --output result.json
+
+Results are written as JSON to allow tracking regressions over time. Use
+``--quick`` for smaller data sets and ``--filter`` to run selected
+benchmarks only. Benchmarks creating nodes additionally report the memory
+retained per node.
+"""
+from node.ext.directory import CompactDirectory
+from node.ext.directory import Directory
+from node.ext.directory import File
+from node.ext.directory import MODE_BINARY
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+def write_files(path, count, data=''):
+    os.mkdir(path)
+    for i in range(count):
+        with open(os.path.join(path, 'file_{0}.txt'.format(i)), 'w') as f:
+            f.write(data)
+
+
+def write_tree(path, depth, fanout, files):
+    os.mkdir(path)
+    for i in range(files):
+        with open(os.path.join(path, 'file_{0}.txt'.format(i)), 'w') as f:
+            f.write('data')
+    if depth:
+        for i in range(fanout):
+            sub_path = os.path.join(path, 'dir_{0}'.format(i))
+            write_tree(sub_path, depth - 1, fanout, files)
+
+
+def load_tree(directory):
+    files = list()
+    for child in directory.values():
+        if isinstance(child, Directory):
+            files.extend(load_tree(child))
+        else:
+            child.data
+            files.append(child)
+    return files
+
+
+###############################################################################
+# Benchmarks
+###############################################################################
+
+# Each benchmark gets a temporary directory and the scale settings and
+# returns a tuple containing parameters and a function which prepares a
+# single run. The preparation function returns the function to be timed.
+# If parameters contain ``nodes``, the timed function must return the created
+# nodes and the memory retained by them gets measured in a separate run.
+BENCHMARKS = list()
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+@benchmark
+def list_directory(tempdir, scale):
+    results = list()
+    for count in scale['entries']:
+        path = os.path.join(tempdir, 'list_{0}'.format(count))
+        write_files(path, count)
+        results.append(('list_directory_{0}'.format(count), {
+            'entries': count
+        }, lambda path=path: lambda: list(Directory(name=path).keys())))
+    return results
+
+
+@benchmark
+def iterate_directory(tempdir, scale):
+    results = list()
+    for count in scale['entries']:
+        path = os.path.join(tempdir, 'iterate_{0}'.format(count))
+        write_files(path, count)
+        results.append(('iterate_directory_{0}'.format(count), {
+            'entries': count
+        }, lambda path=path: lambda: list(Directory(name=path).values())))
+    return results
+
+
+@benchmark
+def getitem_with_factories(tempdir, scale):
+    count = scale['entries'][0]
+    path = os.path.join(tempdir, 'factories')
+    write_files(path, count)
+    factories = dict(
+        ('.ext{0}'.format(i), File) for i in range(scale['factories'])
+    )
+    names = sorted(os.listdir(path))
+
+    def prepare():
+        directory = Directory(name=path, factories=factories)
+        return lambda: [directory[name] for name in names]
+
+    return [('getitem_with_factories', {
+        'entries': count,
+        'factories': len(factories)
+    }, prepare)]
+
+
+@benchmark
+def read_file(tempdir, scale):
+    size = scale['file_size']
+    text_path = os.path.join(tempdir, 'large.txt')
+    with open(text_path, 'w') as f:
+        line = 'x' * 79 + '\n'
+        f.write(line * (size // len(line)))
+    binary_path = os.path.join(tempdir, 'large.bin')
+    with open(binary_path, 'wb') as f:
+        f.write(os.urandom(size))
+
+    def read_text():
+        return lambda: File(name=text_path).data
+
+    def read_binary():
+        file = File(name=binary_path)
+        file.mode = MODE_BINARY
+        return lambda: file.data
+
+    def read_lines():
+        # force indexing the lines, the view is created lazily
+        return lambda: len(File(name=text_path).lines)
+
+    params = {'size': size}
+    return [
+        ('read_text', params, read_text),
+        ('read_binary', params, read_binary),
+        ('read_lines', params, read_lines)
+    ]
+
+
+@benchmark
+def persist_tree(tempdir, scale):
+    depth, fanout, files = scale['tree']
+    path = os.path.join(tempdir, 'tree')
+    write_tree(path, depth, fanout, files)
+    params = {'depth': depth, 'fanout': fanout, 'files': files}
+
+    def prepare(dirty):
+        def prepare_run():
+            directory = Directory(name=path)
+            tree_files = load_tree(directory)
+            for file in tree_files[:dirty or len(tree_files)]:
+                file.data = 'changed'
+            return directory
+        return prepare_run
+
+    return [
+        ('persist_tree_few_dirty', dict(params, dirty=1), prepare(1)),
+        ('persist_tree_all_dirty', dict(params, dirty='all'), prepare(None))
+    ]
+
+
+@benchmark
+def node_memory(tempdir, scale):
+    count = scale['entries'][-1]
+    path = os.path.join(tempdir, 'memory')
+    write_files(path, count, data='data')
+
+    def prepare(factory):
+        def prepare_run():
+            directory = factory(name=path)
+            list(directory.keys())
+            return lambda: [
+                (child, child.data) for child in directory.values()
+            ]
+        return prepare_run
+
+    return [
+        ('node_memory_default', {
+            'nodes': count,
+            'factory': 'Directory'
+        }, prepare(Directory)),
+        ('node_memory_compact', {
+            'nodes': count,
+            'factory': 'CompactDirectory'
+        }, prepare(CompactDirectory))
+    ]
+
+
+###############################################################################
+# Runner
+###############################################################################
+
+SCALES = {
+    'full': {
+        'entries': [10000, 100000],
+        'factories': 200,
+        'file_size': 64 * 1024 * 1024,
+        'tree': (4, 4, 8),
+    },
+    'quick': {
+        'entries': [1000],
+        'factories': 50,
+        'file_size': 1024 * 1024,
+        'tree': (2, 3, 4),
+    },
+}
+
+
+def run_benchmark(prepare, repeat):
+    timings = list()
+    for i in range(repeat):
+        func = prepare()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        'timings': timings,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+    }
+
+
+def measure_memory(prepare):
+    func = prepare()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        nodes = func()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del nodes
+    return size
+
+
+def run(scale, repeat, name_filter=None, log=sys.stderr):
+    results = dict()
+    tempdir = tempfile.mkdtemp()
+    try:
+        for setup in BENCHMARKS:
+            if name_filter and name_filter not in setup.__name__:
+                continue
+            setup_dir = os.path.join(tempdir, setup.__name__)
+            os.mkdir(setup_dir)
+            for name, params, prepare in setup(setup_dir, scale):
+                result = run_benchmark(prepare, repeat)
+                result['params'] = params
+                results[name] = result
+                log.write('{0}: {1:.6f}s\n'.format(name, result['min']))
+                if 'nodes' in params:
+                    memory = measure_memory(prepare)
+                    result['memory'] = memory
+                    result['memory_per_node'] = memory / params['nodes']
+                    log.write('{0}: {1:.0f} bytes per node\n'.format(
+                        name, result['memory_per_node']
+                    ))
+    finally:
+        shutil.rmtree(tempdir)
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'benchmarks': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--output',
+        help='file to write JSON results to, defaults to stdout'
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--filter', dest='name_filter')
+    args = parser.parse_args(argv)
+    scale = SCALES['quick' if args.quick else 'full']
+    result = run(scale, args.repeat, name_filter=args.name_filter)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
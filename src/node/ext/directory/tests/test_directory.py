@@ -1,27 +1,45 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+from node.base import BaseNode
 from node.behaviors import DefaultInit
 from node.behaviors import DictStorage
 from node.behaviors import MappingAdopt
 from node.behaviors import MappingNode
 from node.behaviors import MappingReference
 from node.compat import IS_PY2
+from node.ext.directory import CompactDirectory
+from node.ext.directory import CompactFile
 from node.ext.directory import Directory
 from node.ext.directory import directory
 from node.ext.directory import File
+from node.ext.directory import instrument
+from node.ext.directory import IOStats
 from node.ext.directory import MODE_BINARY
+from node.ext.directory import MODE_MMAP
 from node.ext.directory import MODE_TEXT
+from node.ext.directory.aio import AsyncDirectory
+from node.ext.directory.aio import AsyncFile
 from node.ext.directory.events import IFileAddedEvent
 from node.ext.directory.interfaces import IDirectory
 from node.ext.directory.interfaces import IFile
+from node.ext.directory.watcher import DirectoryWatcher
 from node.tests import NodeTestCase
 from node.tests import patch
 from plumber import plumbing
 from zope import component
+from zope.interface import implementer
+import asyncio
+import errno
+import json
 import logging
 import node.ext.directory
 import os
+import re
 import shutil
+import sys
 import tempfile
+import time
+import tracemalloc
 import unittest
 
 
@@ -68,6 +86,46 @@ class DummyLogger(object):
 dummy_logger = DummyLogger()
 
 
+class CountingListingEntry(object):
+
+    def __init__(self, listing_entry):
+        self.listing_entry = listing_entry
+        self.calls = list()
+
+    def clear(self):
+        self.calls = list()
+
+    def __call__(self, file_path):
+        self.calls.append(file_path)
+        return self.listing_entry(file_path)
+
+
+counting_listing_entry = CountingListingEntry(directory._listing_entry)
+
+
+class RecordingSyncDirectory(object):
+
+    def __init__(self, sync_directory):
+        self.sync_directory = sync_directory
+        self.synced = list()
+
+    def clear(self):
+        self.synced = list()
+
+    def __call__(self, dir_path):
+        self.synced.append(dir_path)
+        self.sync_directory(dir_path)
+
+
+recording_sync_directory = RecordingSyncDirectory(directory._sync_directory)
+
+
+def failing_unlink(path, dir_fd=None):
+    if os.path.basename(path) == 'locked.txt':
+        raise PermissionError(errno.EPERM, 'Operation not permitted', path)
+    os.unlink(path, dir_fd=dir_fd)
+
+
 ###############################################################################
 # Tests
 ###############################################################################
@@ -146,6 +204,137 @@ class TestDirectory(NodeTestCase):
             out = f.read()
         self.assertEqual(out, '\x00\x00')
 
+    def test_file_mode_mmap(self):
+        filepath = os.path.join(self.tempdir, 'file.bin')
+
+        class MappedFile(File):
+            mode = MODE_MMAP
+
+        file = MappedFile(name=filepath)
+        self.assertEqual(file.data, None)
+        err = self.expectError(RuntimeError, lambda: file.lines)
+        self.assertEqual(str(err), 'Cannot read lines from binary file.')
+
+        # empty files cannot be mapped
+        file.data = b''
+        file()
+        file = MappedFile(name=filepath)
+        self.assertEqual(file.data, b'')
+
+        file.data = b'\x00\x01\x02\x03'
+        file()
+        self.assertEqual(file.data, b'\x00\x01\x02\x03')
+
+        # data is a read-only memoryview of the mapped file
+        file = MappedFile(name=filepath)
+        data = file.data
+        self.assertTrue(isinstance(data, memoryview))
+        self.assertTrue(data.readonly)
+        self.assertEqual(data[1:3].tobytes(), b'\x01\x02')
+        self.assertEqual(data.obj, file._mmap)
+        mapped = file._mmap
+
+        # rewriting the file closes the mapping
+        file.data = bytes(data[:2]) + b'\x04'
+        file()
+        self.assertTrue(mapped.closed)
+        self.assertFalse(hasattr(file, '_mmap'))
+        self.assertEqual(file.data, b'\x00\x01\x04')
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), b'\x00\x01\x04')
+
+        # release data closes the mapping, the file gets mapped again on
+        # next access
+        file = MappedFile(name=filepath)
+        data = file.data
+        mapped = file._mmap
+        file._release_data()
+        self.assertTrue(mapped.closed)
+        self.expectError(ValueError, lambda: data[0])
+        self.assertEqual(file.data.tobytes(), b'\x00\x01\x04')
+
+        # evicting the file from the child cache closes the mapping
+        directory = Directory(
+            name=self.tempdir,
+            factories={'.bin': MappedFile},
+            cache_max_entries=1
+        )
+        with open(os.path.join(self.tempdir, 'other.bin'), 'wb') as f:
+            f.write(b'\x05')
+        self.assertEqual(
+            directory['file.bin'].data.tobytes(),
+            b'\x00\x01\x04'
+        )
+        mapped = directory['file.bin']._mmap
+        directory['other.bin']
+        self.assertEqual(list(directory.storage), ['other.bin'])
+        self.assertTrue(mapped.closed)
+
+    def test_file_streaming(self):
+        filepath = os.path.join(self.tempdir, 'file.txt')
+        file = File(name=filepath)
+        self.assertEqual(list(file.iter_chunks()), [])
+        self.assertEqual(list(file.iter_lines()), [])
+
+        # write from iterable
+        file.write_from('line {}\n'.format(i) for i in range(3))
+        self.assertTrue(file._changed)
+        file()
+        self.assertFalse(hasattr(file, '_data'))
+        with open(filepath) as f:
+            self.assertEqual(f.read(), 'line 0\nline 1\nline 2\n')
+
+        # read lazily from disk
+        self.assertEqual(
+            list(file.iter_chunks(size=10)),
+            ['line 0\nlin', 'e 1\nline 2', '\n']
+        )
+        self.assertEqual(list(file.iter_lines()), file.lines)
+        self.assertEqual(
+            list(file.iter_lines()),
+            ['line 0', 'line 1', 'line 2', '']
+        )
+        with file.open_read() as f:
+            self.assertEqual(f.readline(), 'line 0\n')
+
+        # pending changes are read from memory
+        file.data = 'a\nb'
+        self.assertEqual(list(file.iter_lines()), ['a', 'b'])
+
+        # write from file object
+        with open(filepath) as f:
+            other = File(name=os.path.join(self.tempdir, 'other.txt'))
+            other.write_from(f)
+            other()
+        with open(os.path.join(self.tempdir, 'other.txt')) as f:
+            self.assertEqual(f.read(), 'line 0\nline 1\nline 2\n')
+
+        # accessing data consumes the stream
+        file = File(name=filepath)
+        file.write_from(iter(['x', 'y']))
+        self.assertEqual(file.data, 'xy')
+        file()
+        with open(filepath) as f:
+            self.assertEqual(f.read(), 'xy')
+
+        # binary streams
+        class BinaryFile(File):
+            mode = MODE_BINARY
+
+        file = BinaryFile(name=os.path.join(self.tempdir, 'file.bin'))
+        file.write_from([b'\x00', b'\x01'])
+        file()
+        self.assertEqual(list(file.iter_chunks()), [b'\x00\x01'])
+
+        # accessing data joins binary chunks
+        file.write_from(iter([b'\x02', b'\x03']))
+        self.assertEqual(file.data, b'\x02\x03')
+        file()
+        with open(os.path.join(self.tempdir, 'file.bin'), 'rb') as f:
+            self.assertEqual(f.read(), b'\x02\x03')
+        err = self.expectError(RuntimeError, lambda: list(file.iter_lines()))
+        self.assertEqual(str(err), 'Cannot read lines from binary file.')
+
     @unittest.skipIf(os.name == 'nt', 'This test is written for *nix platforms')
     def test_file_permissions(self):
         filepath = os.path.join(self.tempdir, 'file.txt')
@@ -273,6 +462,74 @@ class TestDirectory(NodeTestCase):
         expected = '<File object \'file.txt\' at '
         self.assertTrue(str(directory['file.txt']).startswith(expected))
 
+    def test_file_factory_matcher(self):
+        def txt_factory():
+            pass  # pragma no cover
+
+        def log_factory():
+            pass  # pragma no cover
+
+        def rotated_log_factory():
+            pass  # pragma no cover
+
+        # matcher gets compiled once and rebuilt if a registry changes
+        factories = directory.FactoryRegistry({'.txt': txt_factory})
+        dir = Directory(name=self.tempdir, factories=factories)
+        self.assertEqual(dir._factory_for_ending('a.txt'), txt_factory)
+        matcher = dir._factory_matcher[1]
+        self.assertEqual(dir._factory_for_ending('b.txt'), txt_factory)
+        self.assertTrue(dir._factory_matcher[1] is matcher)
+
+        dir.factories['.log'] = log_factory
+        self.assertEqual(dir._factory_for_ending('a.log'), log_factory)
+        self.assertFalse(dir._factory_matcher[1] is matcher)
+        matcher = dir._factory_matcher[1]
+
+        node.ext.directory.file_factories['.rst'] = txt_factory
+        self.assertEqual(dir._factory_for_ending('a.rst'), txt_factory)
+        self.assertFalse(dir._factory_matcher[1] is matcher)
+        del node.ext.directory.file_factories['.rst']
+        self.assertEqual(dir._factory_for_ending('a.rst'), None)
+
+        # regular expression keys, endings take precedence
+        pattern = re.compile(r'\.log\.\d+$')
+        dir.factories[pattern] = rotated_log_factory
+        self.assertEqual(dir._factory_for_ending('a.log'), log_factory)
+        self.assertEqual(
+            dir._factory_for_ending('a.log.1'),
+            rotated_log_factory
+        )
+        self.assertEqual(dir._factory_for_ending('a.log.x'), None)
+
+        node.ext.directory.file_factories[re.compile(r'\.\d+$')] = \
+            txt_factory
+        self.assertEqual(
+            dir._factory_for_ending('a.log.1'),
+            rotated_log_factory
+        )
+        self.assertEqual(dir._factory_for_ending('a.1'), txt_factory)
+        node.ext.directory.file_factories.clear()
+
+        # plain dicts are supported as well and kept as passed
+        factories = {'.txt': txt_factory}
+        dir = Directory(name=self.tempdir, factories=factories)
+        self.assertTrue(dir.factories is factories)
+        self.assertEqual(dir._factory_for_ending('a.txt'), txt_factory)
+        matcher = dir._factory_matcher[1]
+        self.assertEqual(dir._factory_for_ending('b.txt'), txt_factory)
+        self.assertTrue(dir._factory_matcher[1] is matcher)
+        factories['.log'] = log_factory
+        self.assertEqual(dir._factory_for_ending('a.log'), log_factory)
+
+        # plain dicts defined on the class are supported as well
+        class PlainDictDirectory(Directory):
+            factories = {'.txt': txt_factory}
+
+        dir = PlainDictDirectory(name=self.tempdir)
+        self.assertEqual(dir._factory_for_ending('a.txt'), txt_factory)
+        dir.factories['.log'] = log_factory
+        self.assertEqual(dir._factory_for_ending('a.log'), log_factory)
+
     def test_file_fs_path_fallback(self):
         # Path lookup on ``File`` implementations without ``fs_path`` property
         # falls back to ``path`` property
@@ -418,6 +675,39 @@ class TestDirectory(NodeTestCase):
         err = self.expectError(KeyError, __getitem__fails)
         self.assertEqual(str(err), '\'inexistent\'')
 
+    @patch(directory, '_listing_entry', counting_listing_entry)
+    def test_directory_listing(self):
+        os.mkdir(os.path.join(self.tempdir, 'subdir'))
+        with open(os.path.join(self.tempdir, 'file.txt'), 'w') as f:
+            f.write('')
+        os.symlink(
+            os.path.join(self.tempdir, 'inexistent'),
+            os.path.join(self.tempdir, 'dangling')
+        )
+        counting_listing_entry.clear()
+
+        # children get created from listing without further stat calls
+        dir_ = Directory(name=self.tempdir)
+        self.assertEqual(
+            sorted(dir_.keys()),
+            ['dangling', 'file.txt', 'subdir']
+        )
+        self.assertEqual(sorted(dir_._listing.keys()), ['file.txt', 'subdir'])
+        self.assertTrue(dir_._listing['subdir'].is_dir)
+        self.assertFalse(dir_._listing['file.txt'].is_dir)
+        self.assertTrue(IFile.providedBy(dir_['file.txt']))
+        self.assertTrue(IDirectory.providedBy(dir_['subdir']))
+        self.assertEqual(counting_listing_entry.calls, [])
+
+        # dangling symlinks are not in the listing and get checked
+        self.expectError(KeyError, lambda: dir_['dangling'])
+        self.assertEqual(len(counting_listing_entry.calls), 1)
+
+        # without a listing, child creation stats once
+        dir_ = Directory(name=self.tempdir)
+        self.assertTrue(IDirectory.providedBy(dir_['subdir']))
+        self.assertEqual(len(counting_listing_entry.calls), 2)
+
     @unittest.skipIf(os.name == 'nt', 'This test is written for *nix platforms')
     def test_sub_directory_permissions(self):
         directory = Directory(name=os.path.join(self.tempdir, 'root'))
@@ -481,6 +771,64 @@ class TestDirectory(NodeTestCase):
         directory = DirectoryWithIgnores(name=self.tempdir)
         self.assertEqual(list(directory.keys()), ['file2.txt'])
 
+    def test_ignore_patterns(self):
+        for name in ['a.py', 'a.pyc', '.git', '__pycache__', 'b.tmp', 'c.txt']:
+            with open(os.path.join(self.tempdir, name), 'w') as f:
+                f.write('')
+
+        class DirectoryWithIgnores(Directory):
+            ignores = ['.git', '__pycache__', '*.pyc', re.compile(r'\.tmp$')]
+
+        directory = DirectoryWithIgnores(name=self.tempdir)
+        self.assertEqual(sorted(directory.keys()), ['a.py', 'c.txt'])
+
+        # matcher gets rebuilt if ignores change
+        directory.ignores = ['*.py*']
+        self.assertEqual(
+            sorted(directory.keys()),
+            ['.git', '__pycache__', 'b.tmp', 'c.txt']
+        )
+        directory.ignores.append('c.txt')
+        self.assertEqual(
+            sorted(directory.keys()),
+            ['.git', '__pycache__', 'b.tmp']
+        )
+
+        # deleted names keep order and support membership test by set
+        deleted = directory._deleted
+        del directory['b.tmp']
+        del directory['.git']
+        self.assertEqual(deleted, ['b.tmp', '.git'])
+        self.assertTrue('.git' in deleted)
+        self.assertEqual(deleted.pop(), '.git')
+        self.assertFalse('.git' in deleted)
+        self.assertTrue('b.tmp' in deleted)
+        directory()
+        self.assertEqual(deleted, [])
+        self.assertFalse('b.tmp' in deleted)
+
+        # membership is kept in sync by all list operations
+        names = node.ext.directory.directory._DeletedNames(['a'])
+        names += ['b']
+        self.assertTrue('b' in names)
+        names[0] = 'c'
+        self.assertEqual(names, ['c', 'b'])
+        self.assertFalse('a' in names)
+        self.assertTrue('c' in names)
+        names[1:] = ['d', 'e']
+        self.assertFalse('b' in names)
+        self.assertTrue('e' in names)
+        del names[0]
+        self.assertFalse('c' in names)
+        del names[:1]
+        self.assertFalse('d' in names)
+        names *= 2
+        self.assertEqual(names, ['e', 'e'])
+        names.remove('e')
+        self.assertTrue('e' in names)
+        names *= 0
+        self.assertFalse('e' in names)
+
     @patch(directory, 'logger', dummy_logger)
     def test_backup_setting_removed(self):
         Directory(name=self.tempdir, backup=True)
@@ -502,6 +850,1574 @@ class TestDirectory(NodeTestCase):
             '``Directory`` implementation as of node.ext.directory 0.7'
         ])
 
+    def test_child_cache(self):
+        for name in ['a.txt', 'b.txt', 'c.txt', 'd.txt']:
+            with open(os.path.join(self.tempdir, name), 'w') as f:
+                f.write(name * 10)
+
+        directory = Directory(name=self.tempdir)
+        self.assertEqual(directory._child_cache, None)
+
+        # bound number of cached children
+        directory = Directory(name=self.tempdir, cache_max_entries=2)
+        cache = directory._child_cache
+        self.assertEqual(cache.max_entries, 2)
+        self.assertEqual(directory['a.txt'].data, 'a.txt' * 10)
+        directory['b.txt']
+        self.assertEqual(sorted(directory.storage), ['a.txt', 'b.txt'])
+        directory['c.txt']
+        self.assertEqual(sorted(directory.storage), ['b.txt', 'c.txt'])
+        self.assertEqual(len(directory._index), 3)
+
+        # recently used children are kept
+        directory['b.txt']
+        directory['d.txt']
+        self.assertEqual(sorted(directory.storage), ['b.txt', 'd.txt'])
+
+        # modified children are never evicted
+        directory['a.txt'].data = 'changed'
+        directory['b.txt'].fs_mode = 0o600
+        directory['c.txt']
+        self.assertEqual(
+            sorted(directory.storage),
+            ['a.txt', 'b.txt', 'c.txt']
+        )
+        self.assertEqual(directory['a.txt'].data, 'changed')
+
+        # deleted children are removed from cache
+        del directory['c.txt']
+        self.assertEqual(len(cache.entries), 2)
+
+        # directories with pending changes are never evicted
+        directory = Directory(name=self.tempdir, cache_max_entries=1)
+        subdir = directory['sub'] = Directory()
+        self.assertTrue(subdir._child_cache is directory._child_cache)
+        directory()
+        directory = Directory(name=self.tempdir, cache_max_entries=1)
+        directory['sub']['file.txt'] = File()
+        directory['a.txt']
+        self.assertEqual(sorted(directory.storage), ['a.txt', 'sub'])
+
+        # evicted children get back to their parent if modified
+        directory = Directory(name=self.tempdir, cache_max_entries=1)
+        evicted = directory['a.txt']
+        directory['b.txt']
+        self.assertEqual(sorted(directory.storage), ['b.txt'])
+        evicted.data = 'changed'
+        self.assertTrue(directory['a.txt'] is evicted)
+        self.assertEqual(sorted(directory.storage), ['a.txt'])
+        self.assertEqual(len(directory._index), 2)
+        directory()
+        with open(os.path.join(self.tempdir, 'a.txt')) as f:
+            self.assertEqual(f.read(), 'changed')
+
+        # unmodified children reloaded in the meantime get replaced
+        evicted = directory['b.txt']
+        directory['c.txt']
+        reloaded = directory['b.txt']
+        self.assertFalse(reloaded is evicted)
+        evicted.data = 'changed'
+        self.assertTrue(directory['b.txt'] is evicted)
+        directory()
+        with open(os.path.join(self.tempdir, 'b.txt')) as f:
+            self.assertEqual(f.read(), 'changed')
+
+        # evicted parents get back as well
+        with open(os.path.join(self.tempdir, 'sub', 'file.txt'), 'w') as f:
+            f.write('file')
+        directory = Directory(name=self.tempdir, cache_max_entries=2)
+        sub_file = directory['sub']['file.txt']
+        directory['a.txt']
+        directory['b.txt']
+        self.assertEqual(sorted(directory.storage), ['a.txt', 'b.txt'])
+        sub_file.data = 'changed'
+        self.assertTrue(directory['sub']['file.txt'] is sub_file)
+        directory()
+        with open(os.path.join(self.tempdir, 'sub', 'file.txt')) as f:
+            self.assertEqual(f.read(), 'changed')
+        for name in ['a.txt', 'b.txt']:
+            with open(os.path.join(self.tempdir, name), 'w') as f:
+                f.write(name * 10)
+
+        # bound size of loaded file data
+        directory = Directory(name=self.tempdir, cache_max_bytes=100)
+        self.assertEqual(len(directory['a.txt'].data), 50)
+        self.assertEqual(len(directory['b.txt'].data), 50)
+        self.assertEqual(sorted(directory.storage), ['a.txt', 'b.txt'])
+        self.assertEqual(directory._child_cache.size, 100)
+        directory['d.txt'].data
+        self.assertEqual(sorted(directory.storage), ['b.txt', 'd.txt'])
+        self.assertEqual(directory._child_cache.size, 100)
+
+    def test_dirty_tracking(self):
+        # nodes not created from file system are dirty
+        dirty = node.ext.directory.directory._is_dirty
+        directory = Directory(name=os.path.join(self.tempdir, 'root'))
+        self.assertTrue(dirty(directory))
+        directory['file.txt'] = File()
+        self.assertTrue(dirty(directory['file.txt']))
+        directory['subdir'] = Directory()
+        directory['subdir']['sub.txt'] = File()
+        directory()
+        self.assertEqual(directory.persist_stats.written, 4)
+        self.assertEqual(directory.persist_stats.deleted, 0)
+        self.assertFalse(directory._dirty)
+        self.assertFalse(directory['subdir']['sub.txt']._dirty)
+
+        # nothing to write
+        directory()
+        self.assertEqual(directory.persist_stats.written, 0)
+
+        # children created from file system are clean
+        directory = Directory(name=os.path.join(self.tempdir, 'root'))
+        directory()
+        subdir = directory['subdir']
+        sub_file = subdir['sub.txt']
+        self.assertFalse(directory._dirty)
+        self.assertFalse(subdir._dirty)
+        self.assertFalse(sub_file._dirty)
+        self.assertFalse(directory['file.txt']._dirty)
+
+        # changes mark node and parents dirty
+        sub_file.data = 'changed'
+        self.assertTrue(sub_file._dirty)
+        self.assertTrue(subdir._dirty)
+        self.assertTrue(directory._dirty)
+        self.assertFalse(directory['file.txt']._dirty)
+        directory()
+        self.assertEqual(directory.persist_stats.written, 1)
+        self.assertFalse(directory._dirty)
+        with open(os.path.join(self.tempdir, 'root', 'subdir', 'sub.txt')) as f:
+            self.assertEqual(f.read(), 'changed')
+
+        # file mode changes
+        directory['file.txt'].fs_mode = 0o600
+        self.assertTrue(directory._dirty)
+        directory()
+        self.assertEqual(directory.persist_stats.written, 1)
+        self.assertEqual(
+            os.stat(os.path.join(self.tempdir, 'root', 'file.txt')).st_mode
+            & 0o777,
+            0o600
+        )
+
+        # deletion
+        del directory['subdir']
+        self.assertTrue(directory._dirty)
+        directory()
+        self.assertEqual(directory.persist_stats.written, 0)
+        self.assertEqual(directory.persist_stats.deleted, 1)
+        self.assertEqual(
+            os.listdir(os.path.join(self.tempdir, 'root')),
+            ['file.txt']
+        )
+
+    def test_dirty_tracking_custom_nodes(self):
+        # Nodes created by custom factories without ``_persist`` do not track
+        # changes and get called on every ``__call__``
+        @implementer(IFile)
+        @plumbing(
+            MappingAdopt,
+            DefaultInit,
+            MappingNode,
+            DictStorage)
+        class StructuredFile(object):
+
+            def __call__(self):
+                with open(os.path.join(*self.path), 'w') as f:
+                    f.write('\n'.join(self.keys()))
+
+        root_path = os.path.join(self.tempdir, 'root')
+        os.makedirs(os.path.join(root_path, 'subdir'))
+        file_path = os.path.join(root_path, 'subdir', 'structure.xml')
+        with open(file_path, 'w') as f:
+            f.write('')
+
+        class StructuredDirectory(Directory):
+            factories = {'.xml': StructuredFile}
+
+            @property
+            def child_directory_factory(self):
+                return StructuredDirectory
+
+        directory = StructuredDirectory(name=root_path)
+        structure = directory['subdir']['structure.xml']
+        self.assertIsInstance(structure, StructuredFile)
+        structure['a'] = BaseNode()
+        directory()
+        with open(file_path) as f:
+            self.assertEqual(f.read(), 'a')
+
+        # directories containing such nodes stay dirty
+        self.assertTrue(directory['subdir']._dirty)
+        structure['b'] = BaseNode()
+        directory()
+        with open(file_path) as f:
+            self.assertEqual(f.read(), 'a\nb')
+
+    def test_parallel_persistence(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        directory = Directory(name=root_path)
+        for i in range(3):
+            directory['sub{}'.format(i)] = Directory()
+        for i in range(20):
+            subdir = directory['sub{}'.format(i % 3)]
+            file = subdir['file{}.txt'.format(i)] = File()
+            file.data = str(i)
+            file.direct_sync = True
+        directory(workers=4)
+        self.assertEqual(directory.persist_stats.written, 24)
+        self.assertFalse(directory._dirty)
+        self.assertEqual(
+            sorted(os.listdir(root_path)),
+            ['sub0', 'sub1', 'sub2']
+        )
+        with open(os.path.join(root_path, 'sub2', 'file8.txt')) as f:
+            self.assertEqual(f.read(), '8')
+
+        # executor can be set on directory
+        class RecordingExecutor(ThreadPoolExecutor):
+            submitted = []
+
+            def submit(self, fn, *args):
+                self.submitted.append(fn.__self__.name)
+                return super(RecordingExecutor, self).submit(fn, *args)
+
+        directory = Directory(name=root_path)
+        directory.flush_executor = executor = RecordingExecutor(max_workers=2)
+        directory['sub0']['file0.txt'].data = 'changed'
+        directory()
+        executor.shutdown()
+        self.assertEqual(executor.submitted, ['file0.txt'])
+        with open(os.path.join(root_path, 'sub0', 'file0.txt')) as f:
+            self.assertEqual(f.read(), 'changed')
+
+        # errors get collected
+        directory = Directory(name=root_path)
+        directory['sub0']['file0.txt'].data = 'a'
+        directory['sub1']['invalid'] = File()
+        directory['sub1']['invalid'].data = 'b'
+        os.mkdir(os.path.join(root_path, 'sub1', 'invalid'))
+        err = self.expectError(
+            node.ext.directory.PersistError,
+            directory,
+            workers=2
+        )
+        self.assertEqual(len(err.errors), 1)
+        self.assertEqual(
+            err.errors[0][0],
+            os.path.join(root_path, 'sub1', 'invalid')
+        )
+        self.assertTrue(isinstance(err.errors[0][1], IsADirectoryError))
+        self.assertTrue(str(err).startswith(
+            'Persisting failed for 1 node(s): '
+        ))
+        with open(os.path.join(root_path, 'sub0', 'file0.txt')) as f:
+            self.assertEqual(f.read(), 'a')
+        self.assertFalse(directory['sub0']._dirty)
+        self.assertTrue(directory['sub1']._dirty)
+        self.assertTrue(directory._dirty)
+
+    @unittest.skipIf(os.name == 'nt', 'This test is written for *nix platforms')
+    @patch(directory, '_sync_directory', recording_sync_directory)
+    def test_atomic_write(self):
+        recording_sync_directory.clear()
+        filepath = os.path.join(self.tempdir, 'file.txt')
+        file = File(name=filepath)
+        file.atomic_write = True
+        file.data = 'abc'
+        file()
+        with open(filepath) as f:
+            self.assertEqual(f.read(), 'abc')
+        self.assertEqual(recording_sync_directory.synced, [self.tempdir])
+
+        # file gets replaced, mode of existing file is kept
+        os.chmod(filepath, 0o640)
+        inode = os.stat(filepath).st_ino
+        file.data = 'def'
+        file()
+        with open(filepath) as f:
+            self.assertEqual(f.read(), 'def')
+        self.assertNotEqual(os.stat(filepath).st_ino, inode)
+        self.assertEqual(os.stat(filepath).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.tempdir), ['file.txt'])
+
+        # failing write leaves existing file untouched
+        class FailingFile(File):
+            def _write_data(self, file):
+                file.write('partial')
+                raise IOError('Write failed')
+
+        file = FailingFile(name=filepath)
+        file.atomic_write = True
+        file.data = 'ghi'
+        self.expectError(IOError, file)
+        with open(filepath) as f:
+            self.assertEqual(f.read(), 'def')
+        self.assertEqual(os.listdir(self.tempdir), ['file.txt'])
+
+        # directories get synced once per persist run
+        recording_sync_directory.clear()
+        directory = Directory(name=self.tempdir)
+        directory['file.txt'].data = 'a'
+        directory['file.txt'].atomic_write = True
+        directory['other.txt'] = File()
+        directory['other.txt'].direct_sync = True
+        directory['sub'] = Directory()
+        directory['sub']['file.txt'] = File()
+        directory['sub']['file.txt'].atomic_write = True
+        directory(workers=2)
+        self.assertEqual(
+            sorted(recording_sync_directory.synced),
+            [self.tempdir, os.path.join(self.tempdir, 'sub')]
+        )
+
+    @unittest.skipIf(os.name == 'nt', 'This test is written for *nix platforms')
+    def test_refresh(self):
+        def write(path, data):
+            with open(os.path.join(self.tempdir, *path), 'w') as f:
+                f.write(data)
+
+        def set_past_mtime(*paths):
+            # recent modifications are never trusted
+            past = time.time() - 10
+            for path in paths:
+                os.utime(os.path.join(self.tempdir, *path), (past, past))
+
+        os.mkdir(os.path.join(self.tempdir, 'sub'))
+        write(['a.txt'], 'a')
+        write(['b.txt'], 'b')
+        write(['sub', 'c.txt'], 'c')
+        set_past_mtime([], ['sub'], ['a.txt'], ['b.txt'], ['sub', 'c.txt'])
+
+        directory = Directory(name=self.tempdir)
+        self.assertEqual(sorted(directory.keys()), ['a.txt', 'b.txt', 'sub'])
+        file_a = directory['a.txt']
+        file_b = directory['b.txt']
+        file_c = directory['sub']['c.txt']
+        self.assertEqual(file_a.data, 'a')
+        self.assertEqual(file_b.data, 'b')
+        self.assertEqual(file_c.data, 'c')
+        self.assertEqual(file_a.fs_mode, 0o644 & ~self.umask())
+
+        # nothing changed on disk
+        listing = directory._listing
+        directory.refresh()
+        self.assertTrue(directory._listing is listing)
+        self.assertTrue(directory['a.txt'] is file_a)
+        self.assertEqual(file_a._data, 'a')
+
+        # changed files get reloaded, changed modes get updated
+        write(['a.txt'], 'aa')
+        write(['sub', 'c.txt'], 'cc')
+        os.chmod(os.path.join(self.tempdir, 'b.txt'), 0o600)
+        directory.refresh()
+        self.assertTrue(directory._listing is listing)
+        self.assertFalse(hasattr(file_a, '_data'))
+        self.assertEqual(file_a.data, 'aa')
+        self.assertEqual(file_b._data, 'b')
+        self.assertEqual(file_b.fs_mode, 0o600)
+        self.assertEqual(file_c.data, 'cc')
+
+        # recently modified files get reloaded on each refresh
+        directory.refresh()
+        self.assertFalse(hasattr(file_a, '_data'))
+        set_past_mtime(['a.txt'])
+        self.assertEqual(file_a.data, 'aa')
+        directory.refresh()
+        self.assertEqual(file_a._data, 'aa')
+
+        # removed children get dropped, modified children are kept
+        file_b.data = 'modified'
+        os.remove(os.path.join(self.tempdir, 'a.txt'))
+        os.remove(os.path.join(self.tempdir, 'b.txt'))
+        os.mkdir(os.path.join(self.tempdir, 'new'))
+        directory.refresh()
+        self.assertFalse(directory._listing is listing)
+        self.assertEqual(sorted(directory.storage), ['b.txt', 'sub'])
+        self.assertEqual(len(directory._index), 4)
+        self.assertEqual(sorted(directory.keys()), ['b.txt', 'new', 'sub'])
+        self.assertEqual(directory['b.txt'].data, 'modified')
+
+        # file changed to directory
+        os.remove(os.path.join(self.tempdir, 'sub', 'c.txt'))
+        os.mkdir(os.path.join(self.tempdir, 'sub', 'c.txt'))
+        directory.refresh()
+        self.assertTrue(IDirectory.providedBy(directory['sub']['c.txt']))
+
+    def umask(self):
+        umask = os.umask(0)
+        os.umask(umask)
+        return umask
+
+    @unittest.skipIf(
+        not sys.platform.startswith('linux'),
+        'inotify is only available on Linux'
+    )
+    def test_directory_watcher(self):
+        def write(path, data):
+            with open(os.path.join(self.tempdir, *path), 'w') as f:
+                f.write(data)
+
+        os.mkdir(os.path.join(self.tempdir, 'sub'))
+        write(['a.txt'], 'a')
+        write(['sub', 'b.txt'], 'b')
+
+        directory = Directory(name=self.tempdir)
+        subdir = directory['sub']
+        with DirectoryWatcher(directory) as watcher:
+            self.assertTrue(directory._watcher is watcher)
+            self.assertTrue(subdir._watcher is watcher)
+            self.assertEqual(len(watcher._watches), 2)
+
+            # listing is kept until changes are reported
+            self.assertEqual(sorted(directory.keys()), ['a.txt', 'sub'])
+            listing = directory._listing
+            self.assertEqual(sorted(directory.keys()), ['a.txt', 'sub'])
+            self.assertTrue(directory._listing is listing)
+            self.assertEqual(watcher.process_events(), 0)
+
+            # created files
+            write(['c.txt'], 'c')
+            self.assertTrue(watcher.process_events(timeout=1) > 0)
+            self.assertEqual(
+                sorted(directory.keys()),
+                ['a.txt', 'c.txt', 'sub']
+            )
+            self.assertFalse(directory._listing is listing)
+
+            # modified files
+            file_a = directory['a.txt']
+            file_b = subdir['b.txt']
+            self.assertEqual(file_a.data, 'a')
+            self.assertEqual(file_b.data, 'b')
+            write(['sub', 'b.txt'], 'bb')
+            watcher.process_events(timeout=1)
+            self.assertEqual(file_a._data, 'a')
+            self.assertFalse(hasattr(file_b, '_data'))
+            self.assertEqual(file_b.data, 'bb')
+
+            # modified nodes are kept
+            file_a.data = 'modified'
+            write(['a.txt'], 'aa')
+            watcher.process_events(timeout=1)
+            self.assertEqual(file_a.data, 'modified')
+
+            # deleted files
+            os.remove(os.path.join(self.tempdir, 'sub', 'b.txt'))
+            watcher.process_events(timeout=1)
+            self.assertEqual(list(subdir.storage), [])
+            self.assertEqual(list(subdir.keys()), [])
+
+            # created directories get watched
+            os.mkdir(os.path.join(self.tempdir, 'sub', 'new'))
+            watcher.process_events(timeout=1)
+            self.assertEqual(len(watcher._watches), 3)
+            new = subdir['new']
+            self.assertTrue(new._watcher is watcher)
+            self.assertEqual(list(new.keys()), [])
+            write(['sub', 'new', 'd.txt'], 'd')
+            watcher.process_events(timeout=1)
+            self.assertEqual(list(new.keys()), ['d.txt'])
+
+            # background processing
+            watcher.start()
+            write(['sub', 'new', 'e.txt'], 'e')
+            for i in range(50):
+                if len(new.keys()) == 2:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(sorted(new.keys()), ['d.txt', 'e.txt'])
+            watcher.stop()
+
+        self.assertTrue(watcher.closed)
+        self.assertEqual(directory._watcher, None)
+        self.assertEqual(new._watcher, None)
+
+    def test_walk(self):
+        def write(path, data=''):
+            with open(path, 'w') as f:
+                f.write(data)
+
+        root_path = os.path.join(self.tempdir, 'root')
+        os.mkdir(root_path)
+        os.mkdir(os.path.join(root_path, 'sub'))
+        os.mkdir(os.path.join(root_path, 'sub', 'deep'))
+        os.mkdir(os.path.join(root_path, 'ignored'))
+        write(os.path.join(root_path, 'a.txt'))
+        write(os.path.join(root_path, 'b.py'))
+        write(os.path.join(root_path, 'sub', 'c.txt'))
+        write(os.path.join(root_path, 'sub', 'ignored'))
+        write(os.path.join(root_path, 'sub', 'deep', 'd.txt'))
+        os.symlink(
+            os.path.join(root_path, 'sub'),
+            os.path.join(root_path, 'link')
+        )
+
+        class IgnoringDirectory(Directory):
+            ignores = ['ignored']
+
+            @property
+            def child_directory_factory(self):
+                return IgnoringDirectory
+
+        directory = IgnoringDirectory(name=root_path)
+        result = [
+            (path, sorted(dirnames), sorted(filenames))
+            for path, dirnames, filenames in directory.walk()
+        ]
+        self.assertEqual(sorted(result), [
+            ((), ['link', 'sub'], ['a.txt', 'b.py']),
+            (('sub',), ['deep'], ['c.txt']),
+            (('sub', 'deep'), [], ['d.txt'])
+        ])
+        # no child nodes get created while walking
+        self.assertEqual(list(directory.storage.keys()), [])
+
+        # follow symlinked directories
+        paths = [path for path, _, _ in directory.walk(follow_symlinks=True)]
+        self.assertEqual(sorted(paths), [
+            (), ('link',), ('link', 'deep'), ('sub',), ('sub', 'deep')
+        ])
+
+        # limit depth
+        paths = [path for path, _, _ in directory.walk(max_depth=1)]
+        self.assertEqual(sorted(paths), [(), ('sub',)])
+
+        # prune by modifying dirnames
+        paths = list()
+        for path, dirnames, _ in directory.walk():
+            paths.append(path)
+            if 'deep' in dirnames:
+                dirnames.remove('deep')
+        self.assertEqual(sorted(paths), [(), ('sub',)])
+
+        # iterate files filtered by pattern
+        self.assertEqual(sorted(directory.iter_files(pattern='*.txt')), [
+            ('a.txt',), ('sub', 'c.txt'), ('sub', 'deep', 'd.txt')
+        ])
+        self.assertEqual(
+            sorted(directory.iter_files(pattern='*.txt', max_depth=0)),
+            [('a.txt',)]
+        )
+        self.assertEqual(list(directory.storage.keys()), [])
+
+        # only nodes of matching files get created
+        files = list(directory.iter_files(pattern='c.*', nodes=True))
+        self.assertEqual(len(files), 1)
+        self.assertIsInstance(files[0], File)
+        self.assertEqual(files[0].path[-2:], ['sub', 'c.txt'])
+        self.assertEqual(list(directory.storage.keys()), ['sub'])
+        self.assertEqual(list(directory['sub'].storage.keys()), ['c.txt'])
+
+        # in memory changes of loaded directories are considered
+        directory['sub']['new.txt'] = File()
+        directory['sub']['new'] = Directory()
+        del directory['sub']['deep']
+        result = [
+            (path, sorted(dirnames), sorted(filenames))
+            for path, dirnames, filenames in directory.walk()
+        ]
+        self.assertEqual(sorted(result), [
+            ((), ['link', 'sub'], ['a.txt', 'b.py']),
+            (('sub',), ['new'], ['c.txt', 'new.txt']),
+            (('sub', 'new'), [], [])
+        ])
+
+    def test_glob(self):
+        def write(path, data=''):
+            with open(path, 'w') as f:
+                f.write(data)
+
+        root_path = os.path.join(self.tempdir, 'root')
+        os.mkdir(root_path)
+        os.mkdir(os.path.join(root_path, 'sub'))
+        os.mkdir(os.path.join(root_path, 'sub', 'deep'))
+        os.mkdir(os.path.join(root_path, 'data.json'))
+        write(os.path.join(root_path, 'a.json'))
+        write(os.path.join(root_path, 'a.txt'))
+        write(os.path.join(root_path, 'sub', 'b.json'))
+        write(os.path.join(root_path, 'sub', 'deep', 'c.json'))
+        write(os.path.join(root_path, 'sub', 'deep', 'ignored.json'))
+
+        class IgnoringDirectory(Directory):
+            ignores = ['ignored.json']
+
+            @property
+            def child_directory_factory(self):
+                return IgnoringDirectory
+
+        def paths(nodes):
+            return sorted(tuple(node.path[1:]) for node in nodes)
+
+        directory = IgnoringDirectory(name=root_path)
+        self.assertEqual(paths(directory.glob('*.json')), [
+            ('a.json',), ('data.json',)
+        ])
+        self.assertIsInstance(directory['a.json'], File)
+        self.assertIsInstance(directory['data.json'], Directory)
+        # only nodes for matches get created
+        self.assertEqual(
+            sorted(directory.storage.keys()),
+            ['a.json', 'data.json']
+        )
+
+        self.assertEqual(paths(directory.glob('sub/*/*.json')), [
+            ('sub', 'deep', 'c.json')
+        ])
+        self.assertEqual(paths(directory.glob('*/deep')), [
+            ('sub', 'deep')
+        ])
+        self.assertEqual(paths(directory.glob('sub/missing')), [])
+
+        directory = IgnoringDirectory(name=root_path)
+        self.assertEqual(paths(directory.rglob('*.json')), [
+            ('a.json',),
+            ('data.json',),
+            ('sub', 'b.json'),
+            ('sub', 'deep', 'c.json')
+        ])
+        self.assertEqual(sorted(directory.storage.keys()), [
+            'a.json', 'data.json', 'sub'
+        ])
+        self.assertEqual(sorted(directory['sub'].storage.keys()), [
+            'b.json', 'deep'
+        ])
+        self.assertEqual(paths(directory.glob('**')), [
+            ('data.json',), ('sub',), ('sub', 'deep')
+        ])
+        self.assertEqual(paths(directory.glob('**/**/c.json')), [
+            ('sub', 'deep', 'c.json')
+        ])
+
+        # pending deletes and added children are considered
+        del directory['sub']['b.json']
+        directory['sub']['new.json'] = File()
+        self.assertEqual(paths(directory.rglob('*.json')), [
+            ('a.json',),
+            ('data.json',),
+            ('sub', 'deep', 'c.json'),
+            ('sub', 'new.json')
+        ])
+
+        with self.assertRaises(ValueError):
+            list(directory.glob('/'))
+
+    def test_async_nodes(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        os.mkdir(root_path)
+        with open(os.path.join(root_path, 'a.txt'), 'w') as f:
+            f.write('a')
+        os.mkdir(os.path.join(root_path, 'sub'))
+
+        async def run():
+            directory = AsyncDirectory(name=root_path)
+            names = [name async for name in directory]
+            self.assertEqual(sorted(names), ['a.txt', 'sub'])
+
+            file = await directory.aget('a.txt')
+            self.assertIsInstance(file, AsyncFile)
+            self.assertEqual(await file.read(), 'a')
+            sub = await directory.aget('sub')
+            self.assertIsInstance(sub, AsyncDirectory)
+            self.assertEqual(await directory.aget('missing'), None)
+
+            file.data = 'b'
+            sub['c.txt'] = AsyncFile()
+            sub['c.txt'].data = 'c'
+            await directory.flush(workers=2)
+            self.assertEqual(directory.persist_stats.written, 2)
+
+            # reads of many files are bounded by the executor of the root
+            directory.async_executor = ThreadPoolExecutor(max_workers=2)
+            files = [await directory.aget('a.txt'), sub['c.txt']]
+            data = await asyncio.gather(*[f.read() for f in files])
+            self.assertEqual(data, ['b', 'c'])
+            directory.async_executor.shutdown()
+
+            file = AsyncFile(name=os.path.join(root_path, 'd.txt'))
+            file.data = 'd'
+            await file.flush()
+
+        asyncio.run(run())
+        with open(os.path.join(root_path, 'a.txt')) as f:
+            self.assertEqual(f.read(), 'b')
+        with open(os.path.join(root_path, 'sub', 'c.txt')) as f:
+            self.assertEqual(f.read(), 'c')
+        with open(os.path.join(root_path, 'd.txt')) as f:
+            self.assertEqual(f.read(), 'd')
+
+    def test_instrumentation(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        file_path = os.path.join(root_path, 'file.txt')
+        directory = Directory(name=root_path)
+        directory['file.txt'] = File()
+        directory['file.txt'].data = 'data'
+        directory['file.txt'].direct_sync = True
+        directory['sub'] = Directory()
+
+        self.assertTrue(node.ext.directory.directory._sys is
+                        node.ext.directory.directory._plain_sys)
+        with instrument() as stats:
+            directory()
+        self.assertTrue(node.ext.directory.directory._sys is
+                        node.ext.directory.directory._plain_sys)
+
+        self.assertIsInstance(stats, IOStats)
+        self.assertEqual(stats.count('mkdir'), 2)
+        self.assertEqual(stats.count('open'), 2)
+        self.assertEqual(stats.count('write'), 1)
+        self.assertEqual(stats.count('fsync'), 2)
+        self.assertEqual(stats.count('chmod'), 0)
+        self.assertEqual(stats.bytes_written, 4)
+        self.assertEqual(stats.bytes_read, 0)
+        self.assertTrue(stats.operations['mkdir'].seconds >= 0)
+        file_stats = stats.nodes[file_path]
+        self.assertEqual(file_stats.count('open'), 1)
+        self.assertEqual(file_stats.count('write'), 1)
+        self.assertEqual(file_stats.count('fsync'), 1)
+        self.assertEqual(file_stats.bytes_written, 4)
+        self.assertEqual(stats.nodes[root_path].count('fsync'), 1)
+        self.assertEqual(file_stats.nodes, None)
+
+        # nested instrumentation records into all active stats
+        with instrument() as outer:
+            directory = Directory(name=root_path)
+            with instrument() as inner:
+                self.assertEqual(directory['file.txt'].data, 'data')
+            del directory['sub']
+            directory()
+        self.assertEqual(inner.count('listdir'), 0)
+        self.assertEqual(inner.count('open'), 1)
+        self.assertEqual(inner.count('stat'), 2)
+        self.assertEqual(inner.bytes_read, 4)
+        self.assertEqual(outer.count('open'), 1)
+        self.assertEqual(outer.count('rmtree'), 1)
+        self.assertEqual(outer.bytes_read, 4)
+        self.assertEqual(stats.count('rmtree'), 0)
+        self.assertTrue(node.ext.directory.directory._sys is
+                        node.ext.directory.directory._plain_sys)
+
+    def test_lines_view(self):
+        file_path = os.path.join(self.tempdir, 'file.txt')
+        with open(file_path, 'w') as f:
+            f.write('a\nb\nc\n')
+
+        file = File(name=file_path)
+        lines = file.lines
+        self.assertTrue(file.lines is lines)
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0], 'a')
+        self.assertEqual(lines[-1], '')
+        self.assertEqual(lines[1:3], ['b', 'c'])
+        self.assertEqual(lines, ['a', 'b', 'c', ''])
+        self.assertEqual(list(lines), ['a', 'b', 'c', ''])
+        self.assertEqual(repr(lines), "['a', 'b', 'c', '']")
+        with self.assertRaises(IndexError):
+            lines[4]
+        self.assertFalse(hasattr(file, '_changed'))
+
+        # edits are recorded per line and serialized on data access
+        lines[1] = 'B'
+        lines.insert(0, 'start')
+        del lines[-1]
+        lines.append('end')
+        self.assertTrue(file._changed)
+        self.assertEqual(lines, ['start', 'a', 'B', 'c', 'end'])
+        self.assertTrue(lines.modified)
+        self.assertEqual(file.data, 'start\na\nB\nc\nend')
+        self.assertFalse(lines.modified)
+        self.assertEqual(lines[2], 'B')
+
+        lines[1:3] = ['x']
+        with self.assertRaises(TypeError):
+            lines[0] = 1
+        file()
+        self.assertFalse(lines.modified)
+        with open(file_path) as f:
+            self.assertEqual(f.read(), 'start\nx\nc\nend')
+
+        # setting data or lines resets the view
+        file.data = 'new'
+        self.assertEqual(lines, ['new'])
+        file.lines = ['1', '2']
+        self.assertEqual(file.data, '1\n2')
+        self.assertEqual(len(lines), 2)
+
+        # edits are discarded if data gets replaced
+        lines[0] = 'edited'
+        file.data = 'replaced'
+        self.assertEqual(lines, ['replaced'])
+
+        # empty data has no lines
+        file.data = ''
+        self.assertEqual(len(lines), 0)
+        self.assertEqual(lines, [])
+
+        # concatenation and copies return lists detached from the file
+        file.data = 'a\nb'
+        self.assertEqual(file.lines + ['c'], ['a', 'b', 'c'])
+        self.assertEqual(['z'] + file.lines, ['z', 'a', 'b'])
+        self.assertEqual(file.lines + file.lines, ['a', 'b', 'a', 'b'])
+        copied = file.lines.copy()
+        self.assertIsInstance(copied, list)
+        copied.append('c')
+        self.assertEqual(file.data, 'a\nb')
+        self.assertEqual(json.dumps(list(file.lines)), '["a", "b"]')
+        with self.assertRaises(TypeError):
+            file.lines + 'c'
+
+    def test_file_append(self):
+        file_path = os.path.join(self.tempdir, 'file.log')
+        with open(file_path, 'w') as f:
+            f.write('base\n')
+
+        # appended data is written without loading the base content
+        file = File(name=file_path)
+        file.append('a\n')
+        file.append('b\n')
+        self.assertFalse(hasattr(file, '_data'))
+        self.assertFalse(hasattr(file, '_changed'))
+        self.assertTrue(directory._is_dirty(file))
+        with instrument() as stats:
+            file()
+        self.assertEqual(stats.count('write'), 2)
+        self.assertEqual(stats.bytes_read, 0)
+        self.assertEqual(stats.bytes_written, 4)
+        self.assertFalse(hasattr(file, '_data'))
+        self.assertFalse(hasattr(file, '_appended'))
+        with open(file_path) as f:
+            self.assertEqual(f.read(), 'base\na\nb\n')
+
+        # reading data considers pending appended data
+        file.append('c\n')
+        self.assertEqual(file.data, 'base\na\nb\nc\n')
+        file.append('d\n')
+        self.assertEqual(file.data, 'base\na\nb\nc\nd\n')
+        self.assertEqual(file.lines[-2], 'd')
+        file()
+        with open(file_path) as f:
+            self.assertEqual(f.read(), 'base\na\nb\nc\nd\n')
+
+        # appending to changed data writes the whole file
+        file.data = 'new\n'
+        file.append('e\n')
+        self.assertEqual(file.data, 'new\ne\n')
+        file()
+        with open(file_path) as f:
+            self.assertEqual(f.read(), 'new\ne\n')
+
+        # setting data discards pending appended data
+        file = File(name=file_path)
+        file.append('f\n')
+        file.data = 'replaced'
+        file()
+        with open(file_path) as f:
+            self.assertEqual(f.read(), 'replaced')
+
+        # appending to not existing files creates them
+        new_path = os.path.join(self.tempdir, 'new.bin')
+        file = File(name=new_path)
+        file.mode = MODE_BINARY
+        file.append(b'\x00')
+        self.assertEqual(file.data, b'\x00')
+        file.append(b'\x01')
+        file()
+        with open(new_path, 'rb') as f:
+            self.assertEqual(f.read(), b'\x00\x01')
+
+        # atomically written files get replaced as a whole
+        file = File(name=file_path)
+        file.atomic_write = True
+        file.append('\nx')
+        file()
+        with open(file_path) as f:
+            self.assertEqual(f.read(), 'replaced\nx')
+
+        # streaming reads file contents followed by pending appended data
+        file = File(name=file_path)
+        file.append('y\n')
+        file.append('z')
+        self.assertEqual(
+            list(file.iter_lines()),
+            ['replaced', 'xy', 'z']
+        )
+        self.assertEqual(
+            ''.join(file.iter_chunks(size=4)),
+            'replaced\nxy\nz'
+        )
+        self.assertFalse(hasattr(file, '_data'))
+        self.assertEqual(file.lines, list(file.iter_lines()))
+        with file.open_read() as f:
+            self.assertEqual(f.read(), 'replaced\nxy\nz')
+        file = File(name=os.path.join(self.tempdir, 'pending.txt'))
+        file.append('x\ny')
+        with file.open_read() as f:
+            self.assertEqual(f.read(), 'x\ny')
+        file = File(name=new_path)
+        file.mode = MODE_BINARY
+        file.append(b'\x02')
+        with file.open_read() as f:
+            self.assertEqual(f.read(), b'\x00\x01\x02')
+
+    def test_skip_identical_writes(self):
+        class HashingFile(File):
+            skip_identical_writes = True
+
+        root_path = os.path.join(self.tempdir, 'root')
+        os.mkdir(root_path)
+        with open(os.path.join(root_path, 'a.txt'), 'w') as f:
+            f.write('a')
+        with open(os.path.join(root_path, 'b.bin'), 'wb') as f:
+            f.write(b'b')
+
+        # past modification time, otherwise loaded signatures are not trusted
+        past = time.time() - 60
+        for name in ('a.txt', 'b.bin'):
+            os.utime(os.path.join(root_path, name), (past, past))
+
+        directory = Directory(name=root_path)
+        directory.default_file_factory = HashingFile
+        file = directory['a.txt']
+        self.assertIsInstance(file, HashingFile)
+        self.assertEqual(file.data, 'a')
+        self.assertTrue(file._digest is not None)
+        binary = directory['b.bin']
+        binary.mode = MODE_BINARY
+
+        # identical data is not written, loaded digest is used
+        file.data = 'a'
+        binary.data = b'b'
+        with instrument() as stats:
+            directory()
+        self.assertEqual(directory.persist_stats.written, 0)
+        self.assertEqual(directory.persist_stats.suppressed, 2)
+        self.assertEqual(stats.count('write'), 0)
+        self.assertFalse(hasattr(file, '_changed'))
+        self.assertEqual(os.stat(os.path.join(root_path, 'a.txt')).st_mtime,
+                         past)
+
+        # changed data is written
+        file.data = 'changed'
+        binary.data = b'c'
+        directory()
+        self.assertEqual(directory.persist_stats.written, 2)
+        self.assertEqual(directory.persist_stats.suppressed, 0)
+        with open(os.path.join(root_path, 'b.bin'), 'rb') as f:
+            self.assertEqual(f.read(), b'c')
+
+        # file changed on disk since loading is hashed from disk
+        with open(os.path.join(root_path, 'a.txt'), 'w') as f:
+            f.write('external')
+        file.data = 'changed'
+        directory()
+        self.assertEqual(directory.persist_stats.written, 1)
+        with open(os.path.join(root_path, 'a.txt')) as f:
+            self.assertEqual(f.read(), 'changed')
+        file.data = 'changed'
+        directory()
+        self.assertEqual(directory.persist_stats.suppressed, 1)
+
+        # not loaded files are compared with their contents on disk
+        file = HashingFile(name=os.path.join(root_path, 'a.txt'))
+        file.data = 'changed'
+        file()
+        self.assertEqual(file.persist_stats.suppressed, 1)
+        file.data = 'other'
+        file()
+        self.assertEqual(file.persist_stats.written, 1)
+
+        # disabled by default
+        file = File(name=os.path.join(root_path, 'a.txt'))
+        file.data = 'other'
+        file()
+        self.assertEqual(file.persist_stats.written, 1)
+        self.assertEqual(file.persist_stats.suppressed, 0)
+
+    def test_transactional_persistence(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        os.mkdir(root_path)
+        os.mkdir(os.path.join(root_path, 'old'))
+        with open(os.path.join(root_path, 'old', 'file.txt'), 'w') as f:
+            f.write('old')
+        with open(os.path.join(root_path, 'a.txt'), 'w') as f:
+            f.write('a')
+        with open(os.path.join(root_path, 'log.txt'), 'w') as f:
+            f.write('1\n')
+
+        def read(*path):
+            with open(os.path.join(root_path, *path)) as f:
+                return f.read()
+
+        directory = Directory(name=root_path)
+        directory.transactional = True
+        directory['a.txt'].data = 'changed'
+        directory['log.txt'].append('2\n')
+        del directory['old']
+        directory['old'] = File()
+        directory['old'].data = 'now a file'
+        directory['sub'] = Directory()
+        directory['sub']['b.txt'] = File()
+        directory['sub']['b.txt'].data = 'b'
+        directory['sub']['b.txt'].fs_mode = 0o600
+        directory()
+
+        self.assertEqual(read('a.txt'), 'changed')
+        self.assertEqual(read('log.txt'), '1\n2\n')
+        self.assertEqual(read('old'), 'now a file')
+        self.assertEqual(read('sub', 'b.txt'), 'b')
+        self.assertEqual(
+            os.stat(os.path.join(root_path, 'sub', 'b.txt')).st_mode & 0o777,
+            0o600
+        )
+        self.assertEqual(directory.persist_stats.written, 5)
+        self.assertEqual(directory.persist_stats.deleted, 1)
+        self.assertFalse(node.ext.directory.directory._is_dirty(directory))
+        # staging directory is removed
+        self.assertEqual(os.listdir(self.tempdir), ['root'])
+
+        # failure while applying changes rolls back applied changes
+        class FailingReplace(object):
+
+            def __init__(self, replace):
+                self.replace = replace
+
+            def __call__(self, src, dst):
+                if dst.endswith('fail.txt'):
+                    raise OSError('replace failed')
+                return self.replace(src, dst)
+
+        directory = Directory(name=root_path)
+        directory.transactional = True
+        directory['a.txt'].data = 'rolled back'
+        del directory['old']
+        directory['new'] = Directory()
+        directory['new']['fail.txt'] = File()
+        syscalls = node.ext.directory.directory._plain_sys
+        syscalls.replace = FailingReplace(os.replace)
+        try:
+            with self.assertRaises(OSError):
+                directory()
+        finally:
+            del syscalls.replace
+
+        self.assertEqual(read('a.txt'), 'changed')
+        self.assertEqual(read('old'), 'now a file')
+        self.assertFalse(os.path.exists(os.path.join(root_path, 'new')))
+        self.assertEqual(os.listdir(self.tempdir), ['root'])
+
+        # persist state of nodes is restored
+        self.assertTrue(node.ext.directory.directory._is_dirty(directory))
+        self.assertTrue(directory['a.txt']._changed)
+        self.assertEqual(directory._deleted, ['old'])
+        directory['new']['fail.txt'].data = 'works'
+        directory['new']['ok.txt'] = File()
+        directory()
+        self.assertEqual(read('a.txt'), 'rolled back')
+        self.assertFalse(os.path.exists(os.path.join(root_path, 'old')))
+        self.assertEqual(read('new', 'fail.txt'), 'works')
+
+        # failing to stage a file does not change anything
+        directory = Directory(name=root_path)
+        directory.transactional = True
+        directory['a.txt'].data = 'not written'
+        directory['b'] = Directory()
+        directory['b']['c.txt'] = File()
+        directory['b']['c.txt'].data = 1
+        with self.assertRaises(TypeError):
+            directory()
+        self.assertEqual(read('a.txt'), 'rolled back')
+        self.assertFalse(os.path.exists(os.path.join(root_path, 'b')))
+        self.assertEqual(os.listdir(self.tempdir), ['root'])
+
+        # data of consumed ``write_from`` sources is kept on rollback
+        with open(os.path.join(root_path, 'conflict'), 'w') as f:
+            f.write('')
+        directory = Directory(name=root_path)
+        directory.transactional = True
+        directory['a.txt'].write_from(iter(['hello ', 'world']))
+        directory['conflict'] = Directory()
+        with self.assertRaises(KeyError):
+            directory()
+        self.assertEqual(read('a.txt'), 'rolled back')
+        self.assertEqual(directory['a.txt'].data, 'hello world')
+        os.remove(os.path.join(root_path, 'conflict'))
+        directory()
+        self.assertEqual(read('a.txt'), 'hello world')
+
+        # also if the staged file has been applied already
+        directory = Directory(name=root_path)
+        directory.transactional = True
+        directory['a.txt'].write_from(iter(['applied']))
+        directory['new']['fail.txt'].data = 'fails'
+        syscalls.replace = FailingReplace(os.replace)
+        try:
+            with self.assertRaises(OSError):
+                directory()
+        finally:
+            del syscalls.replace
+        self.assertEqual(read('a.txt'), 'hello world')
+        directory()
+        self.assertEqual(read('a.txt'), 'applied')
+        self.assertEqual(read('new', 'fail.txt'), 'fails')
+
+        # partly consumed sources cannot be persisted again
+        def failing_source():
+            yield 'partly'
+            raise ValueError('source failed')
+
+        directory = Directory(name=root_path)
+        directory.transactional = True
+        directory['a.txt'].write_from(failing_source())
+        with self.assertRaises(ValueError):
+            directory()
+        self.assertTrue(directory['a.txt']._changed)
+        err = self.expectError(RuntimeError, directory)
+        self.assertEqual(str(err), (
+            'Source given to ``write_from`` has been consumed by a failed '
+            'persist run'
+        ))
+        self.assertEqual(read('a.txt'), 'applied')
+        self.assertEqual(os.listdir(self.tempdir), ['root'])
+
+    def test_snapshot_index(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        index_path = os.path.join(self.tempdir, 'index.json')
+        os.mkdir(root_path)
+        os.mkdir(os.path.join(root_path, 'sub'))
+        for path in (('a.txt',), ('sub', 'b.txt')):
+            with open(os.path.join(root_path, *path), 'w') as f:
+                f.write('data')
+        os.symlink(
+            os.path.join(root_path, 'sub'),
+            os.path.join(root_path, 'link')
+        )
+        os.symlink(
+            os.path.join(root_path, 'missing'),
+            os.path.join(root_path, 'dangling')
+        )
+
+        def set_past_mtime(*paths):
+            past = time.time() - 60
+            for path in paths:
+                os.utime(path, (past, past), follow_symlinks=False)
+
+        set_past_mtime(root_path, os.path.join(root_path, 'sub'))
+
+        directory = Directory(name=root_path)
+        with self.assertRaises(ValueError):
+            directory.save_index()
+        directory.save_index(index_path)
+        with open(index_path) as f:
+            data = json.load(f)
+        self.assertEqual(data['version'], 1)
+        self.assertEqual(sorted(data['directories']), ['', 'sub'])
+        entries = dict(
+            (entry[0], entry) for entry in data['directories']['sub'][1]
+        )
+        self.assertEqual(entries['b.txt'][1:3], ['f', 4])
+        entries = dict(
+            (entry[0], entry[1]) for entry in data['directories'][''][1]
+        )
+        self.assertEqual(entries, {
+            'a.txt': 'f',
+            'sub': 'd',
+            'link': 'ld',
+            'dangling': None
+        })
+
+        # listings are taken from the index if directories are unchanged
+        class IndexedDirectory(Directory):
+            index_path = os.path.join(self.tempdir, 'index.json')
+
+            @property
+            def child_directory_factory(self):
+                return IndexedDirectory
+
+        directory = IndexedDirectory(name=root_path)
+        with instrument() as stats:
+            self.assertEqual(
+                sorted(directory.keys()),
+                ['a.txt', 'dangling', 'link', 'sub']
+            )
+            self.assertEqual(list(directory['sub'].keys()), ['b.txt'])
+            self.assertEqual(
+                sorted(directory.iter_files()),
+                [('a.txt',), ('sub', 'b.txt')]
+            )
+        self.assertEqual(stats.count('listdir'), 0)
+        self.assertIsInstance(directory['sub'], IndexedDirectory)
+        self.assertIsInstance(directory['a.txt'], File)
+        self.assertEqual(directory['sub']['b.txt'].data, 'data')
+
+        # changed directories get rescanned
+        with open(os.path.join(root_path, 'sub', 'c.txt'), 'w') as f:
+            f.write('')
+        directory = IndexedDirectory(name=root_path)
+        with instrument() as stats:
+            self.assertEqual(
+                sorted(directory['sub'].keys()),
+                ['b.txt', 'c.txt']
+            )
+        self.assertEqual(stats.count('listdir'), 1)
+
+        # index is written on __call__, unchanged directories are not
+        # rescanned
+        set_past_mtime(os.path.join(root_path, 'sub'))
+        directory['sub']['c.txt'].data = 'c'
+        with instrument() as stats:
+            directory()
+        self.assertEqual(stats.nodes[index_path].count('open'), 0)
+        self.assertEqual(stats.count('listdir'), 1)
+        self.assertEqual(stats.count('replace'), 1)
+        directory = IndexedDirectory(name=root_path)
+        with instrument() as stats:
+            list(directory['sub'].keys())
+        self.assertEqual(stats.count('listdir'), 0)
+
+        # invalid index files are ignored
+        with open(index_path, 'w') as f:
+            f.write('invalid')
+        directory = IndexedDirectory(name=root_path)
+        self.assertEqual(
+            sorted(directory.keys()),
+            ['a.txt', 'dangling', 'link', 'sub']
+        )
+
+    def test_compact_nodes(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        os.mkdir(root_path)
+        for i in range(100):
+            with open(os.path.join(root_path, '{}.txt'.format(i)), 'w') as f:
+                f.write('data')
+        os.mkdir(os.path.join(root_path, 'sub'))
+
+        directory = CompactDirectory(name=root_path)
+        self.assertFalse(hasattr(directory, '__dict__'))
+        self.assertTrue(IDirectory.providedBy(directory))
+        file = directory['0.txt']
+        self.assertIsInstance(file, CompactFile)
+        self.assertTrue(IFile.providedBy(file))
+        self.assertFalse(hasattr(file, '__dict__'))
+        self.assertEqual(file.name, '0.txt')
+        self.assertTrue(file.parent is directory)
+        self.assertEqual(file.data, 'data')
+        self.assertIsInstance(directory['sub'], CompactDirectory)
+
+        # storage of files is never allocated
+        self.assertFalse(hasattr(file, '_storage'))
+
+        # settings are class attributes and cannot be set on instances
+        with self.assertRaises(AttributeError):
+            file.direct_sync = True
+
+        # modify, add and delete children
+        file.data = 'changed'
+        file.fs_mode = 0o600
+        directory['sub']['new.txt'] = CompactFile()
+        directory['sub']['new.txt'].data = 'new'
+        directory['new'] = CompactDirectory()
+        directory['1.txt']
+        del directory['1.txt']
+        directory()
+        self.assertEqual(directory.persist_stats.written, 3)
+        self.assertEqual(directory.persist_stats.deleted, 1)
+        with open(os.path.join(root_path, '0.txt')) as f:
+            self.assertEqual(f.read(), 'changed')
+        self.assertEqual(
+            os.stat(os.path.join(root_path, '0.txt')).st_mode & 0o777,
+            0o600
+        )
+        with open(os.path.join(root_path, 'sub', 'new.txt')) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertTrue(os.path.isdir(os.path.join(root_path, 'new')))
+        self.assertFalse(os.path.exists(os.path.join(root_path, '1.txt')))
+
+        # settings get customized by subclassing
+        class TransactionalDirectory(CompactDirectory):
+            transactional = True
+            cache_max_entries = 10
+
+        # settings cannot be passed to the constructor
+        with self.assertRaises(TypeError) as arc:
+            CompactDirectory(name=root_path, cache_max_entries=10)
+        self.assertEqual(str(arc.exception), (
+            '``cache_max_entries`` cannot be set on ``CompactDirectory`` '
+            'instances, define it on a subclass instead'
+        ))
+        for kw in [
+            {'factories': {'.txt': CompactFile}},
+            {'cache_max_bytes': 10},
+            {'max_open_dirs': 10}
+        ]:
+            with self.assertRaises(TypeError):
+                CompactDirectory(name=root_path, **kw)
+
+        directory = TransactionalDirectory(name=root_path)
+        self.assertEqual(len(list(directory.values())), 101)
+        self.assertEqual(len(directory.storage), 10)
+        directory['2.txt'].data = 'transactional'
+        directory()
+        with open(os.path.join(root_path, '2.txt')) as f:
+            self.assertEqual(f.read(), 'transactional')
+
+        # compact nodes need less memory than default nodes
+        def loaded_size(factory):
+            directory = factory(name=root_path)
+            list(directory.keys())
+            tracemalloc.start()
+            try:
+                for child in directory.values():
+                    child.name
+                return tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+
+        self.assertLess(loaded_size(CompactDirectory), loaded_size(Directory))
+
+        # compact directories can be watched
+        if sys.platform.startswith('linux'):
+            directory = CompactDirectory(name=root_path)
+            with DirectoryWatcher(directory):
+                self.assertEqual(len(list(directory.keys())), 101)
+
+    @patch(directory._SysCalls, 'unlink', staticmethod(failing_unlink))
+    def test_delete_many(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        os.mkdir(root_path)
+        for name in ['a.txt', 'b.txt', 'c.txt', 'locked.txt']:
+            with open(os.path.join(root_path, name), 'w') as f:
+                f.write(name)
+        for name in ['sub', 'big']:
+            for i in range(3):
+                os.makedirs(os.path.join(root_path, name, str(i), 'deep'))
+        with open(os.path.join(root_path, 'big', 'file.txt'), 'w') as f:
+            f.write('big')
+        os.symlink(
+            os.path.join(root_path, 'sub'),
+            os.path.join(root_path, 'link')
+        )
+        os.symlink('missing', os.path.join(root_path, 'dangling'))
+
+        directory = Directory(name=root_path)
+        directory['a.txt'].data = 'changed'
+        directory['new.txt'] = File()
+
+        # unknown names raise, nothing gets deleted
+        err = self.expectError(
+            KeyError,
+            directory.delete_many,
+            ['b.txt', 'unknown']
+        )
+        self.assertEqual(str(err), "'unknown'")
+        self.assertEqual(list(directory._deleted), [])
+
+        # names are looked up in the directory listing, only names not
+        # contained get stat, children are dropped from memory
+        with instrument() as stats:
+            directory.delete_many([
+                'a.txt', 'b.txt', 'new.txt', 'link', 'dangling', 'big'
+            ])
+        self.assertEqual(stats.count('listdir'), 0)
+        self.assertEqual(stats.count('stat'), 2)
+        self.assertEqual(
+            sorted(directory._deleted),
+            ['a.txt', 'b.txt', 'big', 'dangling', 'link']
+        )
+        self.assertEqual(list(directory.storage), [])
+        self.assertEqual(
+            sorted(directory.keys()),
+            ['c.txt', 'locked.txt', 'sub']
+        )
+
+        # files and symlinks get unlinked relative to the opened directory by
+        # types from listing, subdirectories of deleted directories get
+        # removed in parallel by the executor
+        with instrument() as stats:
+            directory(workers=2)
+        self.assertEqual(directory.persist_stats.deleted, 5)
+        dangling_path = os.path.join(root_path, 'dangling')
+        self.assertEqual(stats.nodes[dangling_path].count('stat'), 1)
+        self.assertEqual(stats.nodes[dangling_path].count('remove'), 1)
+        self.assertEqual(stats.nodes[root_path].count('open'), 1)
+        self.assertEqual(stats.nodes[root_path].count('remove'), 0)
+        self.assertEqual(stats.count('remove'), 6)
+        self.assertEqual(stats.count('rmtree'), 3)
+        self.assertEqual(
+            sorted(os.listdir(root_path)),
+            ['c.txt', 'locked.txt', 'sub']
+        )
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(root_path, 'sub'))),
+            ['0', '1', '2']
+        )
+        self.assertEqual(list(directory._deleted), [])
+        self.assertFalse(directory._dirty)
+
+        # errors are reported per entry, failed names are kept for next run
+        directory = Directory(name=root_path)
+        directory.delete_many(['c.txt', 'locked.txt'])
+        err = self.expectError(node.ext.directory.PersistError, directory)
+        self.assertEqual(len(err.errors), 1)
+        self.assertEqual(
+            err.errors[0][0],
+            os.path.join(root_path, 'locked.txt')
+        )
+        self.assertTrue(isinstance(err.errors[0][1], PermissionError))
+        self.assertEqual(directory.persist_stats.deleted, 1)
+        self.assertEqual(list(directory._deleted), ['locked.txt'])
+        self.assertTrue(directory._dirty)
+        self.assertEqual(
+            sorted(os.listdir(root_path)),
+            ['locked.txt', 'sub']
+        )
+
+        # deleting by ``__delitem__`` uses the listing if present
+        directory = Directory(name=root_path)
+        directory['sub']
+        with instrument() as stats:
+            del directory['sub']
+        self.assertEqual(stats.count('stat'), 1)
+        directory = Directory(name=root_path)
+        list(directory.keys())
+        with instrument() as stats:
+            del directory['sub']
+            directory()
+        self.assertEqual(stats.count('stat'), 1)
+        self.assertEqual(stats.count('rmtree'), 1)
+        self.assertEqual(os.listdir(root_path), ['locked.txt'])
+        self.expectError(KeyError, directory.__delitem__, 'sub')
+
+    def test_max_open_dirs(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        deep_path = os.path.join(root_path, 'sub', 'deep')
+        os.makedirs(deep_path)
+        for name in ['a.txt', 'b.txt']:
+            with open(os.path.join(deep_path, name), 'w') as f:
+                f.write(name)
+
+        directory = Directory(name=root_path, max_open_dirs=2)
+        deep = directory['sub']['deep']
+        self.assertTrue(deep._dir_fds is directory._dir_fds)
+        self.assertEqual(deep['a.txt'].data, 'a.txt')
+        # least recently used directories get closed
+        self.assertEqual(len(directory._dir_fds), 2)
+
+        # file system calls are relative to the opened directories and do
+        # not resolve the path from root
+        moved_path = os.path.join(self.tempdir, 'moved')
+        os.rename(root_path, moved_path)
+        with instrument() as stats:
+            self.assertEqual(deep['b.txt'].data, 'b.txt')
+        self.assertEqual(stats.count('open'), 1)
+        deep['b.txt'].data = 'changed'
+        deep['b.txt'].fs_mode = 0o600
+        deep['new'] = Directory()
+        deep['new']['c.txt'] = File()
+        deep['new']['c.txt'].data = 'c'
+        deep['new']['c.txt'].atomic_write = True
+        del deep['a.txt']
+        deep()
+        self.assertEqual(deep.persist_stats.written, 3)
+        self.assertEqual(deep.persist_stats.deleted, 1)
+        self.assertEqual(len(directory._dir_fds), 2)
+        moved_deep_path = os.path.join(moved_path, 'sub', 'deep')
+        self.assertEqual(sorted(os.listdir(moved_deep_path)), ['b.txt', 'new'])
+        with open(os.path.join(moved_deep_path, 'b.txt')) as f:
+            self.assertEqual(f.read(), 'changed')
+        self.assertEqual(
+            os.stat(os.path.join(moved_deep_path, 'b.txt')).st_mode & 0o777,
+            0o600
+        )
+        with open(os.path.join(moved_deep_path, 'new', 'c.txt')) as f:
+            self.assertEqual(f.read(), 'c')
+        os.rename(moved_path, root_path)
+
+        # descriptors of deleted directories get closed
+        directory = Directory(name=root_path, max_open_dirs=10)
+        self.assertEqual(
+            sorted(directory['sub']['deep'].keys()),
+            ['b.txt', 'new']
+        )
+        self.assertEqual(len(directory._dir_fds), 3)
+        del directory['sub']
+        self.assertEqual(len(directory._dir_fds), 1)
+        directory._dir_fds.close()
+        self.assertEqual(len(directory._dir_fds), 0)
+
+        # descriptors in use are not closed
+        cache = directory._dir_fds
+        cache.max_entries = 1
+        with cache.opened(directory) as fd:
+            directory['sub']['deep'].keys()
+            self.assertEqual(os.fstat(fd).st_ino, os.stat(root_path).st_ino)
+        self.assertEqual(len(cache), 1)
+
+        # children of directories not persisted yet behave as in path mode
+        directory = Directory(name=root_path, max_open_dirs=10)
+        directory['unpersisted'] = Directory()
+        file = directory['unpersisted']['file.txt'] = File()
+        self.assertEqual(file.fs_mode, None)
+        self.assertEqual(file.data, '')
+        self.assertEqual(directory['unpersisted'].fs_mode, None)
+        file.refresh()
+        directory['unpersisted'].refresh()
+        directory()
+        self.assertEqual(
+            os.listdir(os.path.join(root_path, 'unpersisted')),
+            ['file.txt']
+        )
+
+    def test_memoized_fs_path(self):
+        root_path = os.path.join(self.tempdir, 'root')
+        os.makedirs(os.path.join(root_path, 'a', 'b'))
+        with open(os.path.join(root_path, 'a', 'b', 'file.txt'), 'w') as f:
+            f.write('data')
+
+        directory = Directory(name=root_path)
+        file = directory['a']['b']['file.txt']
+        self.assertEqual(file.fs_path, [root_path, 'a', 'b', 'file.txt'])
+
+        # paths are memoized and built from the memoized parent path
+        memo = file._fs_path_memo
+        self.assertEqual(file.data, 'data')
+        self.assertTrue(file._fs_path_memo is memo)
+        self.assertEqual(
+            directory['a']._fs_path_memo.path,
+            [root_path, 'a']
+        )
+
+        # returned path is a copy
+        file.fs_path.append('other')
+        self.assertEqual(file.fs_path, [root_path, 'a', 'b', 'file.txt'])
+
+        # renaming root invalidates memoized paths of the tree
+        new_root_path = os.path.join(self.tempdir, 'new_root')
+        os.rename(root_path, new_root_path)
+        directory.__name__ = new_root_path
+        self.assertEqual(
+            file.fs_path,
+            [new_root_path, 'a', 'b', 'file.txt']
+        )
+
+        # moving a directory invalidates memoized paths of its children
+        directory['c'] = directory['a'].detach('b')
+        self.assertEqual(file.fs_path, [new_root_path, 'c', 'file.txt'])
+        file.data = 'moved'
+        directory()
+        with open(os.path.join(new_root_path, 'c', 'file.txt')) as f:
+            self.assertEqual(f.read(), 'moved')
+        self.assertFalse(os.path.exists(os.path.join(new_root_path, 'a', 'b')))
+
+        # customized fs_path is used instead of memoized path
+        class CustomPathDirectory(Directory):
+            @property
+            def fs_path(self):
+                return [new_root_path, 'c']
+
+        custom = CustomPathDirectory(name='custom')
+        self.assertEqual(list(custom.keys()), ['file.txt'])
+
     def test_node_index(self):
         directory = Directory(name=os.path.join(self.tempdir, 'root'))
         self.assertEqual(len(directory._index), 1)
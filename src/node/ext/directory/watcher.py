@@ -0,0 +1,301 @@
+from node.ext.directory.directory import _is_dirty
+from node.ext.directory.interfaces import IDirectory
+from node.locking import TreeLock
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+
+logger = logging.getLogger('node.ext.directory')
+
+
+# inotify constants, see ``man 7 inotify``
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        raise RuntimeError('inotify is only available on Linux')
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise RuntimeError(                                 # pragma no cover
+            'inotify is not supported by libc'
+        )
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_uint32
+    ]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class DirectoryWatcher(object):
+    """Watch a directory tree with Linux inotify and invalidate cached
+    listings, children and file data of the directory node on changes.
+
+    Watched directories keep their listing until a change is reported, thus
+    iterating them does not rescan the file system. Modified nodes are never
+    touched.
+
+    Events are processed either by calling ``process_events`` or by a
+    background thread started with ``start``. Call ``close`` when done.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._libc = _load_libc()
+        self._fd = _check(self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        # watch descriptor -> path relative to directory as tuple
+        self._watches = dict()
+        self._thread = None
+        self._stop = threading.Event()
+        self._root_path = os.path.join(*directory.fs_path)
+        self._add_watches(())
+        _attach(directory, self)
+
+    @property
+    def closed(self):
+        return self._fd is None
+
+    def _add_watch(self, path):
+        fs_path = os.path.join(self._root_path, *path)
+        try:
+            wd = _check(self._libc.inotify_add_watch(
+                self._fd,
+                os.fsencode(fs_path),
+                WATCH_MASK
+            ))
+        except OSError as e:
+            # directory vanished or is no directory
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise
+        self._watches[wd] = path
+        return True
+
+    def _add_watches(self, path):
+        # Watch directory and all its subdirectories. Symlinks are not
+        # followed.
+        if not self._add_watch(path):
+            return
+        try:
+            iterator = os.scandir(os.path.join(self._root_path, *path))
+        except OSError:
+            return
+        with iterator:
+            subdirs = [
+                entry.name for entry in iterator
+                if entry.is_dir(follow_symlinks=False)
+            ]
+        for name in subdirs:
+            self._add_watches(path + (name,))
+
+    def _remove_watches(self, path):
+        # Remove watches of directory and all its subdirectories
+        size = len(path)
+        for wd, watched in list(self._watches.items()):
+            if watched[:size] == path:
+                del self._watches[wd]
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self):
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = list()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(
+                buffer,
+                offset
+            )
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name) if name else None))
+        return events
+
+    def process_events(self, timeout=0):
+        """Process pending events. Wait up to ``timeout`` seconds for events
+        if none are pending, ``None`` waits forever.
+
+        Return number of processed events.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return 0
+        count = 0
+        with TreeLock(self.directory):
+            while True:
+                events = self._read_events()
+                if not events:
+                    break
+                for wd, mask, name in events:
+                    self._handle_event(wd, mask, name)
+                count += len(events)
+        return count
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events got lost, fall back to stat based refresh
+            logger.warning('inotify event queue overflow, refresh directory')
+            _invalidate_listings(self.directory)
+            self.directory.refresh()
+            return
+        path = self._watches.get(wd)
+        if path is None:
+            return
+        if mask & IN_IGNORED:
+            del self._watches[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF) or name is None:
+            return
+        is_dir = mask & IN_ISDIR
+        if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            self._add_watches(path + (name,))
+        elif is_dir and mask & IN_MOVED_FROM:
+            self._remove_watches(path + (name,))
+        node = _loaded_node(self.directory, path)
+        if node is None:
+            return
+        if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+            _invalidate_entry(node, name)
+        elif mask & (IN_MODIFY | IN_CLOSE_WRITE):
+            _invalidate_data(node, name)
+        elif mask & IN_ATTRIB:
+            _invalidate_fs_mode(node, name)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.process_events(timeout=0.2)
+            except Exception:                               # pragma no cover
+                logger.exception('Processing inotify events failed')
+
+    def start(self):
+        """Process events in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='DirectoryWatcher',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop background thread."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def close(self):
+        """Stop watching. Listings are rescanned on access again."""
+        if self.closed:
+            return
+        self.stop()
+        os.close(self._fd)
+        self._fd = None
+        self._watches = dict()
+        _attach(self.directory, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _attach(directory, watcher):
+    # Set watcher on directory and all its loaded child directories
+    directory._watcher = watcher
+    directory._listing_watched = False
+    for child in directory.storage.values():
+        if IDirectory.providedBy(child):
+            _attach(child, watcher)
+
+
+def _loaded_node(directory, path):
+    # Return loaded node by path without creating children
+    node = directory
+    for name in path:
+        node = node.storage.get(name)
+        if node is None or not IDirectory.providedBy(node):
+            return None
+    return node
+
+
+def _invalidate_listings(directory):
+    directory._listing_watched = False
+    if hasattr(directory, '_listing_sig'):
+        del directory._listing_sig
+    for child in directory.storage.values():
+        if IDirectory.providedBy(child):
+            _invalidate_listings(child)
+
+
+def _invalidate_entry(directory, name):
+    # Child got created, deleted or moved
+    directory._listing_watched = False
+    directory._listing.pop(name, None)
+    child = directory.storage.get(name)
+    if child is not None and not _is_dirty(child):
+        directory._drop_child(name)
+
+
+def _invalidate_data(directory, name):
+    child = directory.storage.get(name)
+    if child is None or hasattr(child, '_changed'):
+        return
+    if hasattr(child, '_release_data'):
+        child._release_data()
+
+
+def _invalidate_fs_mode(directory, name):
+    child = directory.storage.get(name)
+    if child is None:
+        return
+    if not hasattr(child, '_fs_mode_changed') and hasattr(child, '_fs_mode'):
+        del child._fs_mode